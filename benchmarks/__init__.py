@@ -0,0 +1,12 @@
+"""Benchmarks and load tests, results are saved with the commit they ran on"""
+
+import subprocess
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,66 @@
+"""Compare two benchmark results saved by `benchmarks.run`
+
+Prints median durations of both runs and their ratio.
+Exits with status 1 if any benchmark got slower by more than the threshold.
+
+Usage:
+    python -m benchmarks.compare old.json new.json --threshold 1.2
+"""
+
+import argparse
+import json
+import sys
+
+
+def _flatten(results) -> dict:
+    flat = {f"helpers: {name}": stats for name, stats in results["helpers"].items()}
+    for size, routes in results["routes"].items():
+        flat.update({f"[{size}] {name}": stats for name, stats in routes.items()})
+    return flat
+
+
+def compare(old, new, threshold) -> list:
+    """Print comparison table, return names of regressed benchmarks"""
+    old, new = _flatten(old), _flatten(new)
+    regressed = []
+    width = max(map(len, new), default=0)
+    print(f"{'benchmark':<{width}}  {'old, ms':>10}  {'new, ms':>10}  ratio")
+    for name, stats in new.items():
+        if name not in old:
+            print(f"{name:<{width}}  {'-':>10}  {stats['median'] * 1000:>10.3f}")
+            continue
+        ratio = stats["median"] / old[name]["median"]
+        marker = ""
+        if ratio > threshold:
+            regressed.append(name)
+            marker = "  REGRESSION"
+        print(
+            f"{name:<{width}}  {old[name]['median'] * 1000:>10.3f}"
+            f"  {stats['median'] * 1000:>10.3f}  {ratio:.2f}{marker}"
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="ratio of new to old median considered a regression",
+    )
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    if compare(old, new, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
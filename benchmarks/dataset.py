@@ -0,0 +1,96 @@
+"""Synthetic dataset generator for benchmarks
+
+Generates users with ids prefixed by `bench-` and spreads birthdays between them.
+Only benchmark users and their birthdays are ever removed, so the generator can be
+pointed at a database with real data, though admin endpoints will include it.
+
+Usage:
+    CONFIG_FILE_PATH=./bench.ini python -m benchmarks.dataset --size 100000
+"""
+
+import argparse
+import datetime
+import random
+
+from peewee import chunked
+
+from src.app.migrations import migrate
+from src.app.models import Birthdays, Tombstones, Users, day_of_year, db, init_db
+
+USER_PREFIX = "bench-"
+INSERT_BATCH_SIZE = 1000
+
+
+def bench_user(number) -> str:
+    return f"{USER_PREFIX}{number}"
+
+
+def clear():
+    """Remove benchmark users and their birthdays"""
+    with db.atomic():
+        bench_users = Users.select(Users.telegram_id).where(
+            Users.telegram_id.startswith(USER_PREFIX)
+        )
+        Birthdays.delete().where(Birthdays.creator.in_(bench_users)).execute()
+        Tombstones.delete().where(Tombstones.creator.in_(bench_users)).execute()
+        Users.delete().where(Users.telegram_id.startswith(USER_PREFIX)).execute()
+
+
+def _birthdays(size, users, seed):
+    """Yield birthday rows spread evenly between users"""
+    generator = random.Random(seed)
+    today = datetime.date.today()
+    for number in range(size):
+        birthday = today - datetime.timedelta(days=generator.randrange(1, 365 * 80))
+        if (birthday.month, birthday.day) == (2, 29):
+            birthday -= datetime.timedelta(days=1)
+        yield {
+            "name": f"Person {number}",
+            "day": birthday.day,
+            "month": birthday.month,
+            "year": birthday.year if generator.random() < 0.7 else None,
+            "note": f"Note {number}" if generator.random() < 0.3 else None,
+            "day_of_year": day_of_year(birthday.month, birthday.day),
+            "creator": bench_user(number % users),
+        }
+
+
+def generate(size, per_user=100, seed=0) -> int:
+    """Replace benchmark data with `size` birthdays, `per_user` per user
+
+    Returns the number of generated users
+    """
+    users = max(1, size // per_user)
+    clear()
+    with db.atomic():
+        for batch in chunked(
+            ({"telegram_id": bench_user(number)} for number in range(users)),
+            INSERT_BATCH_SIZE,
+        ):
+            Users.insert_many(batch).execute()
+        for batch in chunked(_birthdays(size, users, seed), INSERT_BATCH_SIZE):
+            Birthdays.insert_many(batch).execute()
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1000, help="number of birthdays")
+    parser.add_argument("--per-user", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--clear", action="store_true", help="only remove benchmark data"
+    )
+    args = parser.parse_args()
+
+    init_db()
+    migrate()
+    if args.clear:
+        clear()
+        return
+    users = generate(args.size, args.per_user, args.seed)
+    print(f"Generated {args.size} birthdays for {users} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""Load generator replaying bot and web traffic against a running instance
+
+Every simulated user is a thread with its own HTTP session. Users log in once,
+then send requests picked at random from a traffic mix, until the duration ends.
+Results are reported per operation: throughput, latency percentiles, statuses
+and error rate. Requests failing or returning unexpected statuses are errors,
+requests rejected by admission control (`429`, `503`) are counted as shed.
+
+Simulated users are benchmark users, `--size` generates their data first and
+`--clear` removes it afterwards. Bot token and database are taken from the config.
+Login storms from one address are rate limited, unless the instance trusts
+`X-Forwarded-For` (`[Admission] proxies`) and `--forwarded-for` is given.
+
+Usage:
+    CONFIG_FILE_PATH=./bench.ini python -m benchmarks.loadtest \\
+        --url http://127.0.0.1:8080 --mix bot_polling --users 50 --duration 60
+"""
+
+import argparse
+import base64
+import datetime
+import hmac
+import itertools
+import json
+import platform
+import random
+import threading
+import time
+from collections import Counter
+from hashlib import sha256
+
+import requests
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from benchmarks import dataset, git_commit
+from src.app import config
+from src.app.migrations import migrate
+from src.app.models import init_db
+
+TELEGRAM_BOT_TOKEN = config.get("Main", "telegram_bot_token")
+BATCH_SIZE = 20
+# Operation weights of traffic mixes
+MIXES = {
+    "login_storm": {"login_bot": 3, "login_widget": 1},
+    "bot_polling": {"list": 1},
+    "nightly": {"incoming": 1},
+    "bulk_adds": {"add": 1, "batch": 1},
+    "peak": {
+        "list": 60,
+        "one": 10,
+        "login_bot": 10,
+        "login_widget": 5,
+        "add": 10,
+        "batch": 2,
+        "incoming": 3,
+    },
+}
+# Statuses which are not errors, `304` and `404` are valid for empty or unchanged data
+EXPECTED = {
+    "login_bot": (200,),
+    "login_widget": (200,),
+    "list": (200, 304, 404),
+    "one": (200, 404),
+    "add": (201,),
+    "batch": (200,),
+    "incoming": (200, 404),
+}
+SHED = (429, 503)
+
+
+def parse_mix(value) -> dict:
+    """Parse a mix name or weights like `list=9,add=1`"""
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for part in value.split(","):
+        operation, _, weight = part.partition("=")
+        if operation.strip() not in EXPECTED:
+            raise ValueError(f"Unknown operation: {operation.strip()}")
+        mix[operation.strip()] = int(weight or 1)
+    return mix
+
+
+def _percentile(samples, share):
+    return samples[round(share * (len(samples) - 1))]
+
+
+class Recorder:
+    """Thread-safe latencies and statuses by operation"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, status, seconds):
+        with self._lock:
+            self.latencies.setdefault(operation, []).append(seconds)
+            self.statuses.setdefault(operation, Counter())[status] += 1
+
+    def summary(self, duration) -> dict:
+        result = {}
+        for operation, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            statuses = self.statuses[operation]
+            shed = sum(statuses[status] for status in SHED)
+            errors = sum(
+                count
+                for status, count in statuses.items()
+                if status not in EXPECTED[operation] and status not in SHED
+            )
+            result[operation] = {
+                "requests": len(samples),
+                "throughput": len(samples) / duration,
+                "p50": _percentile(samples, 0.5),
+                "p95": _percentile(samples, 0.95),
+                "p99": _percentile(samples, 0.99),
+                "max": samples[-1],
+                "statuses": {str(status): count for status, count in statuses.items()},
+                "error_rate": errors / len(samples),
+                "shed_rate": shed / len(samples),
+            }
+        return result
+
+
+class SimulatedUser:
+    """HTTP session of one user, sending requests of the mix"""
+
+    def __init__(self, number, url, public_key, admin_token=None, forwarded_for=False):
+        self.telegram_id = dataset.bench_user(number)
+        self.url = url
+        self.public_key = public_key
+        self.session = requests.Session()
+        self.admin = {"Authorization": f"Bearer {admin_token}"}
+        if forwarded_for:
+            address = f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}"
+            self.session.headers["X-Forwarded-For"] = address
+        self.names = itertools.count()
+        self.birthday_ids = []
+        self.token = None
+
+    def _encrypted_bot_id(self) -> str:
+        """Encrypt the bot token anew, so the server can't use cached decryptions"""
+        encrypted = self.public_key.encrypt(
+            TELEGRAM_BOT_TOKEN.encode("utf-8"),
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None,
+            ),
+        )
+        return base64.b64encode(encrypted).decode("utf-8")
+
+    def _widget_data(self) -> dict:
+        data = {
+            "id": self.telegram_id,
+            "first_name": "Load",
+            "auth_date": str(int(time.time())),
+        }
+        data_string = "\n".join(f"{key}={value}" for key, value in sorted(data.items()))
+        secret_key = sha256(TELEGRAM_BOT_TOKEN.encode("utf-8")).digest()
+        data["hash"] = hmac.new(
+            secret_key, data_string.encode("utf-8"), digestmod=sha256
+        ).hexdigest()
+        return data
+
+    def _login(self, params):
+        response = self.session.get(f"{self.url}/login", params=params)
+        token = response.cookies.get("access_token_cookie")
+        # Tokens are sent in headers, so requests don't need CSRF tokens
+        self.session.cookies.clear()
+        if token is not None:
+            self.token = token
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        return response
+
+    def _birthday(self) -> dict:
+        return {
+            "name": f"load-{next(self.names)}-{random.random():.6f}",
+            "day": random.randint(1, 28),
+            "month": random.randint(1, 12),
+        }
+
+    def login_bot(self):
+        return self._login(
+            {"id": self.telegram_id, "encrypted_bot_id": self._encrypted_bot_id()}
+        )
+
+    def login_widget(self):
+        return self._login(self._widget_data())
+
+    def list(self):
+        return self.session.get(f"{self.url}/birthdays")
+
+    def one(self):
+        if not self.birthday_ids:
+            return self.list()
+        id = random.choice(self.birthday_ids)
+        return self.session.get(f"{self.url}/birthdays/{id}")
+
+    def add(self):
+        response = self.session.post(f"{self.url}/birthdays", json=self._birthday())
+        if response.status_code == 201:
+            self.birthday_ids.append(response.json()["id"])
+        return response
+
+    def batch(self):
+        operations = [
+            {"op": "create", "birthday": self._birthday()} for _ in range(BATCH_SIZE)
+        ]
+        return self.session.post(f"{self.url}/birthdays/batch", json=operations)
+
+    def incoming(self):
+        return self.session.get(
+            f"{self.url}/admin/birthdays/incoming",
+            params={"days": "0,1,7"},
+            headers=self.admin,
+        )
+
+    def set_up(self, deadline):
+        """Log in and find the user's birthdays, retrying until the deadline"""
+        while self.token is None and time.monotonic() < deadline:
+            try:
+                if self.login_bot().status_code != 200:
+                    time.sleep(random.uniform(0.1, 1))
+            except requests.RequestException:
+                time.sleep(random.uniform(0.1, 1))
+        response = self.list()
+        if response.status_code == 200:
+            self.birthday_ids = [birthday["id"] for birthday in response.json()]
+
+
+def _run_user(user, mix, deadline, think, recorder, seed):
+    rng = random.Random(seed)
+    operations, weights = zip(*mix.items())
+    user.set_up(deadline)
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        start = time.perf_counter()
+        try:
+            status = getattr(user, operation)().status_code
+        except requests.RequestException:
+            status = "failed"
+        recorder.record(operation, status, time.perf_counter() - start)
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+
+
+def run(url, mix, users, duration, think=0, forwarded_for=False, seed=0) -> dict:
+    public_pem = requests.get(f"{url}/public-key").json()["public_key"]
+    public_key = load_pem_public_key(public_pem.encode("utf-8"))
+
+    admin = SimulatedUser(0, url, public_key)
+    response = admin.session.get(
+        f"{url}/admin/login", params={"encrypted_bot_id": admin._encrypted_bot_id()}
+    )
+    admin_token = response.cookies.get("access_token_cookie")
+
+    simulated = [
+        SimulatedUser(number, url, public_key, admin_token, forwarded_for)
+        for number in range(users)
+    ]
+    recorder = Recorder()
+    start = time.monotonic()
+    threads = [
+        threading.Thread(
+            target=_run_user,
+            args=(user, mix, start + duration, think, recorder, seed + number),
+        )
+        for number, user in enumerate(simulated)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "url": url,
+            "mix": mix,
+            "users": users,
+            "duration": elapsed,
+            "think": think,
+        },
+        "operations": recorder.summary(elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument(
+        "--mix",
+        default="peak",
+        help=f"one of {', '.join(MIXES)} or weights like list=9,add=1",
+    )
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument(
+        "--think", type=float, default=0, help="mean seconds between user's requests"
+    )
+    parser.add_argument(
+        "--forwarded-for",
+        action="store_true",
+        help="send every user from its own address in X-Forwarded-For",
+    )
+    parser.add_argument("--size", type=int, help="generate this many birthdays first")
+    parser.add_argument("--per-user", type=int, default=100)
+    parser.add_argument("--clear", action="store_true", help="remove data afterwards")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to save results to")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.size or args.clear:
+        init_db()
+        migrate()
+    if args.size:
+        dataset.generate(args.size, args.per_user, args.seed)
+
+    results = run(
+        args.url,
+        mix,
+        args.users,
+        args.duration,
+        args.think,
+        args.forwarded_for,
+        args.seed,
+    )
+    for operation, result in results["operations"].items():
+        print(
+            f"{operation}: {result['throughput']:.1f} req/s,"
+            f" p50 {result['p50'] * 1000:.1f} ms, p95 {result['p95'] * 1000:.1f} ms,"
+            f" p99 {result['p99'] * 1000:.1f} ms,"
+            f" errors {result['error_rate']:.1%}, shed {result['shed_rate']:.1%}"
+        )
+
+    if args.clear:
+        dataset.clear()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
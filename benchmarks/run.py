@@ -0,0 +1,390 @@
+"""Micro-benchmarks of every route and of the expensive helpers
+
+Routes are called through the Flask test client against the database from the
+config file, so the benchmark database is chosen with `CONFIG_FILE_PATH`.
+Benchmark data is generated for every size before its routes are timed.
+Results are saved as JSON, compare two runs with `benchmarks.compare`.
+
+Usage:
+    CONFIG_FILE_PATH=./bench.ini python -m benchmarks.run --sizes 1000,100000 --output new.json
+"""
+
+import argparse
+import base64
+import datetime
+import hmac
+import io
+import json
+import platform
+import statistics
+import time
+from hashlib import sha256
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from flask_jwt_extended import create_access_token
+
+from benchmarks import dataset, git_commit
+from src.app import admission, config, keys, stats
+from src.app.digest import digest
+from src.app.endpoints import birthdays_cache
+from src.app.migrations import migrate
+from src.app.models import Birthdays, BirthdaysSchema
+from src.app.utils import TELEGRAM_BOT_TOKEN, _check_telegram_data, _decrypt
+from src.birthday_api import app
+
+
+def measure(func, repeat, warmup) -> dict:
+    """Run `func` and return statistics of its durations in seconds"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "runs": repeat,
+        "mean": statistics.fmean(samples),
+        "median": statistics.median(samples),
+        "p95": samples[round(0.95 * (len(samples) - 1))],
+        "min": samples[0],
+        "max": samples[-1],
+    }
+
+
+def _encrypt(data) -> str:
+    public_key = load_pem_public_key(keys.public_key.get()[0].encode("utf-8"))
+    encrypted = public_key.encrypt(
+        data.encode("utf-8"),
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None,
+        ),
+    )
+    return base64.b64encode(encrypted).decode("utf-8")
+
+
+def _telegram_data(telegram_id) -> dict:
+    """Return login widget data signed with the bot token"""
+    data = {
+        "id": telegram_id,
+        "first_name": "Bench",
+        "auth_date": str(int(time.time())),
+    }
+    data_string = "\n".join(f"{key}={value}" for key, value in sorted(data.items()))
+    secret_key = sha256(TELEGRAM_BOT_TOKEN.encode("utf-8")).digest()
+    data["hash"] = hmac.new(
+        secret_key, data_string.encode("utf-8"), digestmod=sha256
+    ).hexdigest()
+    return data
+
+
+class Client:
+    """Test client authenticated with bearer tokens, checking response statuses"""
+
+    def __init__(self, telegram_id):
+        # Login routes are called far above their rate limit
+        admission.EXEMPT_CLIENTS.add("127.0.0.1")
+        self.client = app.test_client(use_cookies=False)
+        with app.app_context():
+            user_token = create_access_token(identity={"telegram_id": telegram_id})
+            admin_token = create_access_token(
+                identity="admin", additional_claims={"is_admin": True}
+            )
+        self.user = {"Authorization": f"Bearer {user_token}"}
+        self.admin = {"Authorization": f"Bearer {admin_token}"}
+
+    def call(self, method, url, expected=(200,), **kwargs):
+        response = self.client.open(url, method=method, **kwargs)
+        response.get_data()
+        if response.status_code not in expected:
+            raise RuntimeError(
+                f"{method} {url} returned {response.status_code}: {response.get_data(as_text=True)}"
+            )
+        return response
+
+
+def route_benchmarks(telegram_id):
+    """Return benchmarked operations by name, routes are called as `telegram_id`"""
+    client = Client(telegram_id)
+    user, admin = client.user, client.admin
+    birthdays = {
+        birthday.pop("id"): birthday
+        for birthday in Birthdays.select(
+            Birthdays.id,
+            Birthdays.name,
+            Birthdays.day,
+            Birthdays.month,
+            Birthdays.year,
+            Birthdays.note,
+        )
+        .where(Birthdays.creator == telegram_id)
+        .order_by(Birthdays.id)
+        .limit(10)
+        .dicts()
+    }
+    birthday_id, birthday_data = next(iter(birthdays.items()))
+    encrypted_bot_id = _encrypt(TELEGRAM_BOT_TOKEN)
+    # Version after all but the last few changes of the user
+    sync_version = (
+        Birthdays.select(Birthdays.version)
+        .where(Birthdays.creator == telegram_id)
+        .order_by(Birthdays.version.desc())
+        .offset(10)
+        .limit(1)
+        .scalar()
+        or 0
+    )
+    created_ids = []
+    counter = iter(range(10**9))
+
+    def add_birthday():
+        response = client.call(
+            "POST",
+            "/birthdays",
+            expected=(201,),
+            headers=user,
+            json={"name": f"Bench added {next(counter)}", "day": 1, "month": 1},
+        )
+        created_ids.append(response.get_json()["id"])
+
+    def delete_birthday():
+        if not created_ids:
+            add_birthday()
+        client.call(
+            "DELETE",
+            f"/birthdays/{created_ids.pop()}",
+            expected=(204,),
+            headers=user,
+        )
+
+    def cold(url, headers):
+        """Request bypassing the users' birthdays cache"""
+
+        def request():
+            birthdays_cache.invalidate(telegram_id)
+            client.call("GET", url, headers=headers)
+
+        return request
+
+    def cold_bot_login():
+        keys.decrypted_cache.clear()
+        client.call(
+            "GET",
+            "/login",
+            query_string={"id": telegram_id, "encrypted_bot_id": encrypted_bot_id},
+        )
+
+    def import_birthdays():
+        """Import new names every time, so rows are inserted rather than skipped"""
+        prefix = next(counter)
+        import_file = "name,day,month,year,note\n" + "".join(
+            f"Bench imported {prefix}-{number},{number % 28 + 1},{number % 12 + 1},,\n"
+            for number in range(100)
+        )
+        client.call(
+            "POST",
+            "/birthdays/import?format=csv",
+            headers=user,
+            data=io.BytesIO(import_file.encode("utf-8")),
+            content_type="text/csv",
+        )
+
+    def cold_stats(url):
+        """Request recomputing stats, as after a write"""
+
+        def request():
+            stats.mark_stale()
+            client.call("GET", url, headers=admin)
+
+        return request
+
+    def digest_after_write():
+        digest.mark_stale(telegram_id)
+        client.call(
+            "GET", "/admin/birthdays/digest", expected=(200, 404), headers=admin
+        )
+
+    def digest_rebuilt():
+        digest.rebuild(datetime.datetime.now(datetime.timezone.utc).date())
+        client.call(
+            "GET", "/admin/birthdays/digest", expected=(200, 404), headers=admin
+        )
+
+    batch = [
+        {"op": "update", "id": id, "birthday": birthday}
+        for id, birthday in birthdays.items()
+    ]
+
+    return {
+        "GET /public-key": lambda: client.call("GET", "/public-key"),
+        "GET /login bot, cold": cold_bot_login,
+        "GET /login bot, cached": lambda: client.call(
+            "GET",
+            "/login",
+            query_string={"id": telegram_id, "encrypted_bot_id": encrypted_bot_id},
+        ),
+        "GET /login widget": lambda: client.call(
+            "GET", "/login", query_string=_telegram_data(telegram_id)
+        ),
+        "GET /logout": lambda: client.call("GET", "/logout", headers=user),
+        "GET /birthdays, cold": cold("/birthdays", user),
+        "GET /birthdays, cached": lambda: client.call(
+            "GET", "/birthdays", headers=user
+        ),
+        "GET /birthdays?since": lambda: client.call(
+            "GET", "/birthdays", headers=user, query_string={"since": sync_version}
+        ),
+        "GET /birthdays/search": lambda: client.call(
+            "GET",
+            "/birthdays/search",
+            headers=user,
+            query_string={"q": birthday_data["name"]},
+        ),
+        "GET /birthdays/search prefix": lambda: client.call(
+            "GET", "/birthdays/search", headers=user, query_string={"q": "Pers"}
+        ),
+        "GET /birthdays/<id>, cold": cold(f"/birthdays/{birthday_id}", user),
+        "GET /birthdays/<id>, cached": lambda: client.call(
+            "GET", f"/birthdays/{birthday_id}", headers=user
+        ),
+        "POST /birthdays": add_birthday,
+        "DELETE /birthdays/<id>": delete_birthday,
+        "PUT /birthdays/<id>": lambda: client.call(
+            "PUT", f"/birthdays/{birthday_id}", headers=user, json=birthday_data
+        ),
+        "PATCH /birthdays/<id>": lambda: client.call(
+            "PATCH",
+            f"/birthdays/{birthday_id}",
+            headers=user,
+            json={"note": birthday_data["note"]},
+        ),
+        "POST /birthdays/batch": lambda: client.call(
+            "POST", "/birthdays/batch", headers=user, json=batch
+        ),
+        "GET /birthdays/export csv": lambda: client.call(
+            "GET", "/birthdays/export?format=csv", headers=user
+        ),
+        "GET /birthdays/export ics": lambda: client.call(
+            "GET", "/birthdays/export?format=ics", headers=user
+        ),
+        "POST /birthdays/import csv": import_birthdays,
+        "GET /admin/login": lambda: client.call(
+            "GET", "/admin/login", query_string={"encrypted_bot_id": encrypted_bot_id}
+        ),
+        "GET /admin/birthdays/incoming": lambda: client.call(
+            "GET", "/admin/birthdays/incoming", expected=(200, 404), headers=admin
+        ),
+        "GET /admin/birthdays/incoming 0..30": lambda: client.call(
+            "GET",
+            "/admin/birthdays/incoming?days=0..30",
+            expected=(200, 404),
+            headers=admin,
+        ),
+        "GET /admin/birthdays/all": lambda: client.call(
+            "GET", "/admin/birthdays/all", headers=admin
+        ),
+        "GET /admin/birthdays/all page": lambda: client.call(
+            "GET", "/admin/birthdays/all?limit=1000", headers=admin
+        ),
+        "GET /admin/birthdays/all ndjson": lambda: client.call(
+            "GET", "/admin/birthdays/all?format=ndjson", headers=admin
+        ),
+        "GET /admin/birthdays/digest, rebuilt": digest_rebuilt,
+        "GET /admin/birthdays/digest, after write": digest_after_write,
+        "GET /admin/birthdays/digest, cached": lambda: client.call(
+            "GET", "/admin/birthdays/digest", expected=(200, 404), headers=admin
+        ),
+        "GET /admin/stats, cold": cold_stats("/admin/stats"),
+        "GET /admin/stats, cached": lambda: client.call(
+            "GET", "/admin/stats", headers=admin
+        ),
+        "GET /admin/stats/list_sizes, cold": cold_stats("/admin/stats/list_sizes"),
+        "GET /admin/database/pool": lambda: client.call(
+            "GET", "/admin/database/pool", headers=admin
+        ),
+        "GET /metrics": lambda: client.call("GET", "/metrics", headers=admin),
+    }
+
+
+def helper_benchmarks():
+    """Return benchmarked helpers by name"""
+    schema = BirthdaysSchema()
+    birthday = {"name": "Bench", "day": 14, "month": 3, "year": 1990, "note": "note"}
+    telegram_data = _telegram_data("bench-helper")
+    encrypted_bot_id = _encrypt(TELEGRAM_BOT_TOKEN)
+
+    def cold_decrypt():
+        keys.decrypted_cache.clear()
+        _decrypt(encrypted_bot_id)
+
+    return {
+        "BirthdaysSchema.load": lambda: schema.load(birthday),
+        "_check_telegram_data": lambda: _check_telegram_data(dict(telegram_data)),
+        "_decrypt, cold": cold_decrypt,
+        "_decrypt, cached": lambda: _decrypt(encrypted_bot_id),
+    }
+
+
+def run(sizes, per_user, repeat, warmup, only=None) -> dict:
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "database": config.get("Database", "name"),
+            "per_user": per_user,
+            "repeat": repeat,
+        },
+        "helpers": {},
+        "routes": {},
+    }
+
+    for name, func in helper_benchmarks().items():
+        if only is None or only in name:
+            results["helpers"][name] = measure(func, repeat, warmup)
+            print(f"{name}: {results['helpers'][name]['median'] * 1000:.3f} ms")
+
+    migrate()
+    for size in sizes:
+        dataset.generate(size, per_user)
+        routes = results["routes"][str(size)] = {}
+        for name, func in route_benchmarks(dataset.bench_user(0)).items():
+            if only is None or only in name:
+                routes[name] = measure(func, repeat, warmup)
+                print(f"[{size}] {name}: {routes[name]['median'] * 1000:.3f} ms")
+    dataset.clear()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", default="1000", help="comma separated numbers of birthdays"
+    )
+    parser.add_argument("--per-user", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--only", help="run only benchmarks containing this string")
+    parser.add_argument("--output", help="file to save results to")
+    args = parser.parse_args()
+
+    results = run(
+        [int(size) for size in args.sizes.split(",")],
+        args.per_user,
+        args.repeat,
+        args.warmup,
+        args.only,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -115,9 +115,12 @@
                 Environment = lib.optional (cfg.configFile != null)
                   "CONFIG_FILE_PATH=${cfg.configFile}";
 
+                ExecStartPre = "${venv}/bin/birthday-api migrate";
+
                 ExecStart = ''
                   ${venv}/bin/gunicorn \
                     --workers 1 \
+                    --preload \
                     --bind 127.0.0.1:9000 \
                     src.birthday_api:app
                 '';
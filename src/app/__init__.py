@@ -1,21 +1,113 @@
+"""Application factory
+
+Importing the package has no side effects: config file is read on first access,
+routes are registered on the `api` blueprint and the app is built by `create_app`.
+"""
+
 import configparser
+import logging
 import os
 
-from flask import Flask
+from flask import Blueprint, Flask
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 fallback_config_path = os.path.join(os.path.dirname(__file__), "..", "config.ini")
 config_file_path = os.getenv("CONFIG_FILE_PATH", fallback_config_path)
 
-config = configparser.ConfigParser()
-config.read(config_file_path)
 
-app = Flask(__name__)
+class LazyConfigParser(configparser.ConfigParser):
+    """Config parser which reads the config file on first access"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            self.read(self.path)
+
+    def get(self, *args, **kwargs):
+        self._load()
+        return super().get(*args, **kwargs)
+
+    def items(self, *args, **kwargs):
+        self._load()
+        return super().items(*args, **kwargs)
+
+    def sections(self):
+        self._load()
+        return super().sections()
+
+    def has_section(self, section):
+        self._load()
+        return super().has_section(section)
+
+    def has_option(self, section, option):
+        self._load()
+        return super().has_option(section, option)
+
+
+config = LazyConfigParser(config_file_path)
+
+api = Blueprint("api", __name__)
+
+jwt = JWTManager()
+
+
+def _warm_up():
+    """Parse key files, so workers forked from a preloaded app share them"""
+    from src.app import keys
+
+    try:
+        keys.public_key.get()
+        for key_file in keys.private_keys:
+            key_file.get()
+    except Exception as error:
+        logging.warning("Keys are not loaded on startup: %s", error)
+
+
+def create_app():
+    """Create and configure the application
+
+    Doesn't connect to the database, schema is changed by the `migrate` command only
+    """
+    from src.app import (
+        admin_endpoints,
+        digest,
+        endpoints,
+        logger,
+        migrations,
+        models,
+        plans,
+        utils,
+    )
+
+    app = Flask(__name__)
+
+    app.config["JWT_SECRET_KEY"] = config.get("Main", "secret_key")
+    app.config["JWT_TOKEN_LOCATION"] = ["headers", "cookies"]
+
+    jwt.init_app(app)
+
+    CORS(app)
 
-app.config["JWT_SECRET_KEY"] = config.get("Main", "secret_key")
-app.config["JWT_TOKEN_LOCATION"] = ["headers", "cookies"]
+    # Client addresses are used by admission control
+    proxies = config.getint("Admission", "proxies", fallback=0)
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
 
-jwt = JWTManager(app)
+    models.init_db()
+    app.register_blueprint(api)
+    app.cli.add_command(migrations.migrate_command)
+    app.cli.add_command(plans.check_plans_command)
+    _warm_up()
+    if config.getboolean("Digest", "scheduler", fallback=True):
+        app.before_request(digest.start_scheduler)
+    if utils.verification_pool is not None:
+        app.before_request(utils.verification_pool.start)
 
-CORS(app)
+    return app
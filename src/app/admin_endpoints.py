@@ -3,20 +3,61 @@
 import datetime
 import logging
 
-from flask import Response, abort, jsonify, request
+from flask import Response, abort, jsonify, request, stream_with_context
 from flask_jwt_extended import create_access_token, set_access_cookies
 from peewee import DoesNotExist
-from playhouse.shortcuts import model_to_dict
 
-from src.app import app, config
-from src.app.models import Birthdays
+from src.app import api, config, metrics, stats
+from src.app.admission import admission_control
+from src.app.digest import digest
+from src.app.incoming import DEFAULT_WINDOW, find_incoming, parse_window
+from src.app.models import Birthdays, pool_status
+from src.app.replicas import on_replica, read_replica
+from src.app.serializers import (
+    birthday_to_dict,
+    json_response,
+    select_birthdays,
+    to_json,
+)
 from src.app.utils import PubicKeyError, _abort_error, _decrypt, admin_required
 
 JWT_EXPIRES_MINUTES = int(config.get("Main", "jwt_expires_minutes"))
 TELEGRAM_BOT_TOKEN = str(config.get("Main", "telegram_bot_token"))
 
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
 
-@app.route("/admin/login")
+
+def _birthdays_after(after_id, limit):
+    """Return a keyset page of birthdays with ids greater than `after_id`"""
+    return (
+        select_birthdays()
+        .where(Birthdays.id > after_id)
+        .order_by(Birthdays.id)
+        .limit(limit)
+    )
+
+
+def _stream_birthdays(after_id):
+    """Yield birthdays with ids greater than `after_id` as newline-delimited JSON
+
+    The table is walked in keyset batches, so at most one batch is held in memory
+    """
+    # Runs after the route returns, so the replica is chosen here
+    with on_replica():
+        while True:
+            count = 0
+            for row in _birthdays_after(after_id, STREAM_BATCH_SIZE).iterator():
+                count += 1
+                entry = birthday_to_dict(row)
+                after_id = entry["id"]
+                yield to_json(entry) + "\n"
+            if count < STREAM_BATCH_SIZE:
+                return
+
+
+@api.route("/admin/login")
+@admission_control("login")
 def admin_login():
     """Login endpoint for admin
 
@@ -46,64 +87,184 @@ def admin_login():
         logging.error("Admin login failed: Decryption failed due to invalid public key")
         abort(422, description="Decryption failed: Invalid public key")
     except Exception as error:
-        logging.error(f"Admin login error: {error}")
+        logging.error("Admin login error: %s", error)
         _abort_error(error)
 
 
-@app.route("/admin/birthdays/incoming", methods=["GET"])
+@api.route("/admin/birthdays/incoming", methods=["GET"])
 @admin_required
+@read_replica
 def incoming_birthdays():
-    """Return incoming birthdays for today, tomorrow and next week"""
+    """Return incoming birthdays within a look-ahead window
+
+    Request args can have `days` - comma separated offsets and ranges from today,
+    e.g. `0..30`. Defaults to today, tomorrow and next week (`0,1,7`)
+    """
     try:
         logging.info("Fetching incoming birthdays for admin")
 
-        datetimes = {
-            datetime.date.today(): 0,
-            datetime.date.today() + datetime.timedelta(days=1): 1,
-            datetime.date.today() + datetime.timedelta(days=7): 7,
-        }
-        data = []
-        for incoming_in, days_before in datetimes.items():
-            for birthday in Birthdays.select().where(
-                (Birthdays.day == incoming_in.day)
-                & (Birthdays.month == incoming_in.month)
-            ):
-                entry = model_to_dict(birthday)
-                entry["incoming_in_days"] = days_before
-                data.append(entry)
+        offsets = parse_window(request.args.get("days", DEFAULT_WINDOW))
+        data = find_incoming(offsets)
 
         if not data:
             logging.warning("No incoming birthdays found")
             abort(404, description="No incoming birthdays")
 
-        logging.info(f"Found {len(data)} incoming birthdays")
-        return jsonify(data), 200
+        logging.info("Found %s incoming birthdays", len(data))
+        return json_response(data), 200
+    except ValueError as error:
+        logging.warning("Invalid incoming birthdays window: %s", error)
+        abort(400, description="Invalid days window")
     except DoesNotExist:
         logging.warning("No incoming birthdays")
         abort(404, description="No incoming birthdays")
     except Exception as error:
-        logging.error(f"Error fetching incoming birthdays: {error}")
+        logging.error("Error fetching incoming birthdays: %s", error)
+        _abort_error(error)
+
+
+@api.route("/admin/birthdays/digest", methods=["GET"])
+@admin_required
+def birthdays_digest():
+    """Return today's reminder digest, incoming birthdays grouped by user
+
+    Every user gets birthdays incoming from their local date, in the configured window.
+    Request args can have `telegram_id` to return the digest of one user
+    """
+    try:
+        telegram_id = request.args.get("telegram_id")
+        logging.info("Fetching birthdays digest for admin, user: %s", telegram_id)
+
+        data = digest.lookup(telegram_id)
+
+        if not data:
+            logging.warning("Birthdays digest is empty")
+            abort(404, description="No incoming birthdays")
+
+        logging.info("Digest has %s users", len(data))
+        return json_response(data), 200
+    except Exception as error:
+        logging.error("Error fetching birthdays digest: %s", error)
         _abort_error(error)
 
 
-@app.route("/admin/birthdays/all", methods=["GET"])
+@api.route("/admin/birthdays/all", methods=["GET"])
 @admin_required
+@read_replica
 def all_birthdays():
-    """Return ALL birthdays"""
+    """Return ALL birthdays
+
+    Request args can have:
+    - after_id: `int`, return only birthdays with greater ids
+    - limit: `int`, return one page of at most `limit` birthdays ordered by id.
+    Id of the last returned birthday is sent in `X-Next-After-Id` header
+    if there can be more pages
+    - format: `ndjson`, stream birthdays as newline-delimited JSON
+    """
     try:
         logging.info("Fetching all birthdays for admin")
 
-        data = [model_to_dict(birthday) for birthday in Birthdays.select()]
+        after_id = request.args.get("after_id", 0, type=int)
+        limit = request.args.get("limit", type=int)
+
+        if request.args.get("format") == "ndjson":
+            logging.info("Streaming birthdays after id %s", after_id)
+            return Response(
+                stream_with_context(_stream_birthdays(after_id)),
+                mimetype="application/x-ndjson",
+            )
+
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            logging.warning("Invalid page size: %s", limit)
+            abort(400, description=f"Limit should be within 1..{MAX_PAGE_SIZE}")
+
+        page_size = None
+        if limit is None and "after_id" not in request.args:
+            query = select_birthdays().order_by(Birthdays.id)
+        else:
+            page_size = limit or MAX_PAGE_SIZE
+            query = _birthdays_after(after_id, page_size)
+
+        data = [birthday_to_dict(row) for row in query]
 
         if not data:
             logging.warning("No birthdays found")
             abort(404, description="No birthdays")
 
-        logging.info(f"Found {len(data)} birthdays")
-        return jsonify(data), 200
+        logging.info("Found %s birthdays", len(data))
+        response = json_response(data)
+        if page_size is not None and len(data) == page_size:
+            response.headers["X-Next-After-Id"] = str(data[-1]["id"])
+        return response, 200
     except DoesNotExist:
         logging.warning("No birthdays found - DoesNotExist exception")
         abort(404, description="No birthdays")
     except Exception as error:
-        logging.error(f"Error fetching all birthdays: {error}")
+        logging.error("Error fetching all birthdays: %s", error)
+        _abort_error(error)
+
+
+@api.route("/admin/stats", methods=["GET"])
+@admin_required
+@read_replica
+def all_stats():
+    """Return all summaries of birthdays and users
+
+    Summaries are small aggregates computed by the database and cached until the next
+    write, see `birthday_stats` for their names
+    """
+    try:
+        logging.info("Fetching all stats for admin")
+        data = {name: stats.summary(name) for name in stats.SUMMARIES}
+        return json_response(data), 200
+    except Exception as error:
+        logging.error("Error fetching stats: %s", error)
+        _abort_error(error)
+
+
+@api.route("/admin/stats/<name>", methods=["GET"])
+@admin_required
+@read_replica
+def birthday_stats(name):
+    """Return one summary of birthdays and users
+
+    Name can be one of:
+    - totals: numbers of users, birthdays, birthdays with years and with notes
+    - months: numbers of birthdays in every month
+    - weekdays: numbers of birthdays by ISO weekday of their next occurrence
+    - list_sizes: numbers of users by number of their birthdays
+    - languages: numbers of users by language
+    """
+    try:
+        logging.info("Fetching %s stats for admin", name)
+        if name not in stats.SUMMARIES:
+            logging.warning("Unknown stats: %s", name)
+            abort(404, description="Unknown stats")
+        return json_response(stats.summary(name)), 200
+    except Exception as error:
+        logging.error("Error fetching %s stats: %s", name, error)
+        _abort_error(error)
+
+
+@api.route("/admin/database/pool", methods=["GET"])
+@admin_required
+def database_pool():
+    """Return utilization of the database connection pool"""
+    try:
+        status = pool_status()
+        logging.info("Database pool status: %s", status)
+        return jsonify(status), 200
+    except Exception as error:
+        logging.error("Error fetching database pool status: %s", error)
+        _abort_error(error)
+
+
+@api.route("/metrics", methods=["GET"])
+@admin_required
+def metrics_endpoint():
+    """Return request and database metrics in Prometheus text format"""
+    try:
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+    except Exception as error:
+        logging.error("Error rendering metrics: %s", error)
         _abort_error(error)
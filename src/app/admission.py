@@ -0,0 +1,97 @@
+"""Admission control for expensive routes
+
+Every limited route has its own concurrency limit and a token bucket per client
+address. Requests over the limits are rejected at once instead of waiting for a worker:
+`429` when the client runs out of tokens and `503` when the route is busy,
+both with `Retry-After`. Rejected requests are counted in metrics.
+
+Limits are per worker process, settings of a group of routes are read from
+`[Admission]` config section as `<group>_concurrency`, `<group>_rate`
+(tokens per second, positive) and `<group>_burst` (bucket size, at least 1).
+"""
+
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from src.app import config
+from src.app.cache import LRUCache
+from src.app.metrics import shed_requests
+
+TRACKED_CLIENTS = config.getint("Admission", "tracked_clients", fallback=10000)
+EXEMPT_CLIENTS = {
+    client.strip()
+    for client in config.get("Admission", "exempt", fallback="").split(",")
+    if client.strip()
+}
+
+
+class TokenBucket:
+    """Token buckets by client, refilled at `rate` tokens per second up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(TRACKED_CLIENTS)
+        self._lock = threading.Lock()
+
+    def take(self, client) -> float:
+        """Take a token of the client, return seconds to wait if there is none"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets.set(client, (tokens, now))
+                return (1 - tokens) / self.rate
+            self._buckets.set(client, (tokens - 1, now))
+            return 0
+
+
+def admission_control(group):
+    """Decorator limiting concurrency and per-client request rate of the route"""
+    concurrency = config.getint("Admission", f"{group}_concurrency", fallback=4)
+    rate = config.getfloat("Admission", f"{group}_rate", fallback=5)
+    burst = config.getint("Admission", f"{group}_burst", fallback=20)
+    if rate <= 0 or burst < 1:
+        raise ValueError(
+            f"[Admission] {group}_rate should be positive and {group}_burst at least 1"
+        )
+
+    def decorator(func):
+        slots = threading.BoundedSemaphore(concurrency)
+        buckets = TokenBucket(rate, burst)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            client = request.remote_addr
+            if client not in EXEMPT_CLIENTS:
+                wait = buckets.take(client)
+                if wait:
+                    shed_requests.inc(
+                        (("endpoint", request.url_rule.rule), ("reason", "rate"))
+                    )
+                    raise TooManyRequests(
+                        "Too many requests, try again later",
+                        retry_after=math.ceil(wait),
+                    )
+
+            if not slots.acquire(blocking=False):
+                shed_requests.inc(
+                    (("endpoint", request.url_rule.rule), ("reason", "concurrency"))
+                )
+                raise ServiceUnavailable(
+                    "Server is busy, try again later", retry_after=1
+                )
+            try:
+                return func(*args, **kwargs)
+            finally:
+                slots.release()
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,215 @@
+"""Batch changes of a user's birthdays
+
+Operations are validated and checked against the user's birthdays in memory,
+then applied with one set-based statement per operation type in a single transaction.
+"""
+
+from marshmallow import ValidationError
+from peewee import Cast, ValuesList
+
+from src.app.models import Birthdays, BirthdaysSchema, day_of_year, next_version
+from src.app.serializers import birthday_to_dict, select_birthdays
+from src.app.sync import delete_birthdays, user_transaction
+
+MAX_BATCH_SIZE = 1000
+OPERATIONS = ("create", "update", "delete")
+
+
+def _error(status, description, field=None) -> dict:
+    result = {"status": status, "description": description}
+    if field is not None:
+        result["field"] = field
+    return result
+
+
+def _validation_error(messages) -> dict:
+    """Convert validation messages of one birthday to a result"""
+    try:
+        return _error(422, "\n".join(messages["_schema"]), field="date")
+    except KeyError:
+        return _error(422, "Unprocessable birthday data")
+
+
+def _load(operations, results) -> dict:
+    """Validate birthdays of create and update operations
+
+    Returns loaded birthdays by operation index, results of invalid ones are set
+    """
+    schema = BirthdaysSchema()
+    loaded = {}
+    for index, operation in enumerate(operations):
+        if results[index] is not None or operation["op"] == "delete":
+            continue
+        try:
+            loaded[index] = schema.load(operation["birthday"])
+        except ValidationError as error:
+            results[index] = _validation_error(error.messages)
+    return loaded
+
+
+def _update_many(user, updates):
+    """Update birthdays from `(id, birthday)` pairs with one statement"""
+    values = ValuesList(
+        [
+            (
+                id,
+                birthday["name"],
+                birthday["day"],
+                birthday["month"],
+                birthday["year"],
+                birthday["note"],
+                day_of_year(birthday["month"], birthday["day"]),
+            )
+            for id, birthday in updates
+        ],
+        columns=("id", "name", "day", "month", "year", "note", "day_of_year"),
+        alias="new",
+    )
+    Birthdays.update(
+        name=values.c.name,
+        day=Cast(values.c.day, "smallint"),
+        month=Cast(values.c.month, "smallint"),
+        year=Cast(values.c.year, "smallint"),
+        note=Cast(values.c.note, "text"),
+        day_of_year=Cast(values.c.day_of_year, "smallint"),
+        version=next_version(),
+    ).from_(values).where(
+        (Birthdays.id == values.c.id) & (Birthdays.creator == user)
+    ).execute()
+
+
+def _insert_many(user, birthdays) -> dict:
+    """Insert birthdays with one statement, return their ids by name"""
+    rows = [
+        {
+            "name": birthday["name"],
+            "day": birthday["day"],
+            "month": birthday["month"],
+            "year": birthday["year"],
+            "note": birthday["note"],
+            "day_of_year": day_of_year(birthday["month"], birthday["day"]),
+            "creator": user,
+        }
+        for birthday in birthdays
+    ]
+    query = Birthdays.insert_many(rows).returning(Birthdays.name, Birthdays.id)
+    return dict(query.tuples().execute())
+
+
+def _plan(user, operations, loaded, results):
+    """Check operations against the user's birthdays and each other
+
+    Returns deletes, updates and creates to apply, results of skipped operations are set
+    """
+    existing = dict(
+        Birthdays.select(Birthdays.id, Birthdays.name)
+        .where(Birthdays.creator == user)
+        .tuples()
+    )
+    owners = {name: id for id, name in existing.items()}
+    # Updates run in one statement checking unique names row by row, in any order,
+    # so a name one update frees can't be taken by another one
+    renamed = set()
+    changed = set()
+    deletes, updates, creates = [], {}, {}
+
+    for index, operation in enumerate(operations):
+        if results[index] is not None:
+            continue
+
+        id = operation.get("id") if operation["op"] != "create" else None
+        if id is not None:
+            if id in changed:
+                results[index] = _error(
+                    422, "Birthday is changed twice in one batch", field="id"
+                )
+                continue
+            if id not in existing:
+                results[index] = _error(404, "Birthday not found")
+                continue
+
+        if operation["op"] == "delete":
+            changed.add(id)
+            del owners[existing.pop(id)]
+            deletes.append(id)
+            results[index] = {"status": 204}
+            continue
+
+        birthday = loaded[index]
+        if owners.get(birthday["name"], id) != id:
+            results[index] = _error(
+                422, "User already has a birthday with this name", field="name"
+            )
+            continue
+
+        if operation["op"] == "update" and birthday["name"] in renamed:
+            results[index] = _error(
+                422,
+                "Name is freed by another update of this batch, use another batch",
+                field="name",
+            )
+            continue
+
+        if operation["op"] == "update":
+            changed.add(id)
+            if existing[id] != birthday["name"]:
+                renamed.add(existing[id])
+            del owners[existing[id]]
+            existing[id] = birthday["name"]
+            owners[birthday["name"]] = id
+            updates[index] = (id, birthday)
+        else:
+            owners[birthday["name"]] = ("created", index)
+            creates[index] = birthday
+
+    return deletes, updates, creates
+
+
+def apply_batch(user, operations) -> list:
+    """Apply create, update and delete operations to the user's birthdays
+
+    Returns a result for every operation in the same order.
+    Operations that fail validation or conflict with other birthdays are skipped.
+    Birthdays are checked and changed in one `user_transaction`, so other writes
+    of the user wait until the batch is applied
+    """
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            results[index] = _error(400, "Unknown operation", field="op")
+        elif operation["op"] != "create" and (
+            not isinstance(operation.get("id"), int)
+            or isinstance(operation["id"], bool)
+        ):
+            results[index] = _error(400, "Operation should have an id", field="id")
+        elif operation["op"] != "delete" and not isinstance(
+            operation.get("birthday"), dict
+        ):
+            results[index] = _error(
+                400, "Operation should have a birthday", field="birthday"
+            )
+
+    loaded = _load(operations, results)
+
+    with user_transaction(user):
+        deletes, updates, creates = _plan(user, operations, loaded, results)
+        if deletes:
+            delete_birthdays(user, Birthdays.id.in_(deletes))
+        if updates:
+            _update_many(user, updates.values())
+        created = _insert_many(user, creates.values()) if creates else {}
+
+    ids = {index: id for index, (id, _) in updates.items()}
+    ids.update(
+        {index: created[birthday["name"]] for index, birthday in creates.items()}
+    )
+    if ids:
+        serialized = {
+            row[0]: birthday_to_dict(row)
+            for row in select_birthdays().where(Birthdays.id.in_(list(ids.values())))
+        }
+        for index, id in ids.items():
+            status = 200 if index in updates else 201
+            results[index] = {"status": status, "birthday": serialized[id]}
+
+    return results
@@ -0,0 +1,95 @@
+"""Circuit breaker failing database queries fast during outages
+
+A breaker is closed while the database works. After `[CircuitBreaker] failures`
+timeouts or connection errors within `window` seconds it opens, and queries fail
+at once with `503` instead of waiting for the database. After `reset_timeout`
+seconds one query is let through as a probe: if it succeeds the breaker closes,
+otherwise it opens again.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from src.app import config, metrics
+
+FAILURES = config.getint("CircuitBreaker", "failures", fallback=5)
+WINDOW = config.getfloat("CircuitBreaker", "window", fallback=10)
+RESET_TIMEOUT = config.getfloat("CircuitBreaker", "reset_timeout", fallback=5)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DatabaseUnavailable(ServiceUnavailable):
+    """Raised instead of running a query while the breaker is open"""
+
+    def __init__(self, state, retry_after):
+        super().__init__(
+            f"Database is unavailable, circuit breaker is {state}",
+            retry_after=retry_after,
+        )
+        self.state = state
+
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self._failures = deque()
+        self._opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.breaker_transitions.inc((("database", self.name), ("state", state)))
+
+    def check(self):
+        """Raise `DatabaseUnavailable` if a query shouldn't run now"""
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            wait = self._opened + RESET_TIMEOUT - time.monotonic()
+            if self.state == OPEN and wait <= 0:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            if self.state != CLOSED:
+                raise DatabaseUnavailable(self.state, max(1, math.ceil(wait)))
+
+    def record_success(self):
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self._failures.clear()
+                self._set_state(CLOSED)
+
+    def cancel_probe(self):
+        """Let another query probe, if the query let through didn't reach the database"""
+        if self.state == CLOSED:
+            return
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self._opened = now
+                self._set_state(OPEN)
+                return
+            self._failures.append(now)
+            while self._failures[0] < now - WINDOW:
+                self._failures.popleft()
+            if self.state == CLOSED and len(self._failures) >= FAILURES:
+                self._opened = now
+                self._set_state(OPEN)
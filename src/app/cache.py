@@ -0,0 +1,129 @@
+"""In-process caches"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe mapping with bounded size and optional time to live
+
+    When the cache is full, the least recently used entry is evicted.
+    Entries older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value, _ = self._data.pop(key, (default, None))
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserResponseCache:
+    """Serialized responses grouped by user
+
+    All responses of a user are dropped at once by `invalidate`, which should be
+    called after every write. Users are evicted in least recently used order.
+    Invalidation reaches only the current process, so with `ttl` responses of a user
+    are also dropped `ttl` seconds after the first of them was stored
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self._users = LRUCache(maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, user, key):
+        entries = self._users.get(user)
+        return None if entries is None else entries.get(key)
+
+    def entries(self, user):
+        """Return a token for storing responses of the user
+
+        Should be taken before reading data, so the response computed from it
+        is not stored if the user's data changes in the meantime
+        """
+        with self._lock:
+            entries = self._users.get(user)
+            if entries is None:
+                entries = {}
+                self._users.set(user, entries)
+            return entries
+
+    def set(self, user, key, value, entries):
+        with self._lock:
+            if self._users.get(user) is entries:
+                entries[key] = value
+
+    def invalidate(self, user):
+        with self._lock:
+            self._users.pop(user)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls computing the same key
+
+    The first caller computes the value, callers arriving while it is computed
+    wait for it and get the same value or exception. Nothing is kept afterwards
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["value"]
+
+        try:
+            call["value"] = func()
+            return call["value"]
+        except Exception as error:
+            call["error"] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
@@ -0,0 +1,224 @@
+"""Daily reminder digest
+
+Digest maps each user to their birthdays incoming within the reminder window,
+counted from the user's local date. Local dates are at most a day away from the UTC
+date, so digests are built for yesterday, today and tomorrow (UTC) with a single
+query, and a lookup is a dictionary access by date and user.
+
+A background thread rebuilds the digest right after UTC midnight, it is started
+by the first request of every worker. Users set their time zones on login.
+Writes mark their user stale, stale users are recomputed on the next lookup.
+Writes are tracked per worker process, so the digest is also rebuilt on lookup
+every `[Digest] refresh_interval` seconds and changes made through other workers
+are seen eventually.
+Concurrent lookups needing a computation share it.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from src.app import config
+from src.app.cache import SingleFlight
+from src.app.incoming import DEFAULT_WINDOW, keys_condition, parse_window, window_keys
+from src.app.models import Birthdays, Users, db
+from src.app.serializers import birthday_to_dict, select_birthdays
+
+DIGEST_WINDOW = config.get("Digest", "window", fallback=DEFAULT_WINDOW)
+# Seconds after which the digest is rebuilt on lookup, to see writes of other workers
+REFRESH_INTERVAL = config.getint("Digest", "refresh_interval", fallback=60)
+
+
+@lru_cache(maxsize=None)
+def _zone(name):
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logging.warning("Unknown time zone %s, using UTC", name)
+        return datetime.timezone.utc
+
+
+def is_timezone(name) -> bool:
+    """Check that the name is a known IANA time zone, e.g. `Europe/Berlin`"""
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+class Digest:
+    """Birthdays incoming within the window by date and user"""
+
+    def __init__(self, offsets, refresh_interval=None):
+        self.offsets = offsets
+        self.refresh_interval = refresh_interval
+        self._today = None
+        # `time.monotonic()` of the last rebuild
+        self._built = 0
+        # {date: {telegram_id: [birthday, ...]}}
+        self._days = {}
+        self._timezones = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        # Serializes rebuilds and refreshes, so older results never replace newer ones
+        self._update_lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def _compute(self, today, users=None):
+        """Return digests of the users (all by default) and their time zones"""
+        dates = [today + datetime.timedelta(days=offset) for offset in (-1, 0, 1)]
+        keys = {date: window_keys(self.offsets, date) for date in dates}
+        days = {date: {} for date in dates}
+        timezones = {}
+
+        all_keys = set().union(*keys.values())
+        if not all_keys:
+            return days, timezones
+
+        query = select_birthdays(Birthdays.day_of_year, Users.timezone).where(
+            keys_condition(all_keys)
+        )
+        if users is not None:
+            query = query.where(Birthdays.creator.in_(list(users)))
+
+        for row in query:
+            birthday = birthday_to_dict(row)
+            telegram_id = birthday["creator"]["telegram_id"]
+            timezones[telegram_id] = row[-1]
+            for date in dates:
+                offset = keys[date].get(row[-2])
+                if offset is not None:
+                    days[date].setdefault(telegram_id, []).append(
+                        {**birthday, "incoming_in_days": offset}
+                    )
+
+        for digests in days.values():
+            for birthdays in digests.values():
+                birthdays.sort(
+                    key=lambda entry: (entry["incoming_in_days"], entry["id"])
+                )
+        return days, timezones
+
+    def rebuild(self, today):
+        """Replace the digest with the one built for the UTC date"""
+        with self._update_lock:
+            with self._lock:
+                self._stale.clear()
+            built = time.monotonic()
+            days, timezones = self._compute(today)
+            with self._lock:
+                self._today, self._days, self._timezones = today, days, timezones
+                self._built = built
+        logging.info("Digest for %s built, %s users", today, len(days[today]))
+
+    def _refresh(self):
+        """Recompute digests of stale users"""
+        with self._update_lock:
+            with self._lock:
+                users, self._stale = self._stale, set()
+            if not users:
+                return
+
+            days, timezones = self._compute(self._today, users)
+            with self._lock:
+                for date, digests in self._days.items():
+                    for telegram_id in users:
+                        digests.pop(telegram_id, None)
+                    digests.update(days[date])
+                self._timezones.update(timezones)
+
+    def _expired(self) -> bool:
+        return (
+            self.refresh_interval is not None
+            and time.monotonic() - self._built > self.refresh_interval
+        )
+
+    def _update(self, today):
+        if self._today != today or self._expired():
+            self.rebuild(today)
+        else:
+            self._refresh()
+
+    def mark_stale(self, telegram_id):
+        """Recompute digest of the user on the next lookup, should be called after writes"""
+        with self._lock:
+            self._stale.add(telegram_id)
+
+    def lookup(self, telegram_id=None, now=None) -> list:
+        """Return digests for users' local dates, of one user or of all users
+
+        Every digest is a dictionary with `telegram_id`, local `date` and `birthdays`.
+        Users without incoming birthdays are skipped
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        today = now.date()
+        if self._today != today or self._stale or self._expired():
+            self._flight.do("update", lambda: self._update(today))
+
+        with self._lock:
+            days, timezones = self._days, dict(self._timezones)
+        users = sorted(timezones) if telegram_id is None else [telegram_id]
+
+        result = []
+        for user in users:
+            if user not in timezones:
+                continue
+            date = now.astimezone(_zone(timezones[user])).date()
+            birthdays = days.get(date, {}).get(user)
+            if birthdays:
+                result.append(
+                    {
+                        "telegram_id": user,
+                        "date": date.isoformat(),
+                        "birthdays": birthdays,
+                    }
+                )
+        return result
+
+
+digest = Digest(parse_window(DIGEST_WINDOW), REFRESH_INTERVAL or None)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _seconds_until_midnight() -> float:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    midnight = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1), datetime.time(), datetime.timezone.utc
+    )
+    return (midnight - now).total_seconds()
+
+
+def _run_scheduler():
+    while True:
+        time.sleep(_seconds_until_midnight())
+        try:
+            digest.rebuild(datetime.datetime.now(datetime.timezone.utc).date())
+        except Exception as error:
+            logging.error("Error building digest: %s", error)
+        finally:
+            db.close()
+
+
+def start_scheduler():
+    """Start the thread rebuilding the digest after every UTC midnight, unless running
+
+    Called before every request, so the thread runs only in processes serving them:
+    not in a gunicorn master preloading the app, whose connections workers inherit.
+    Threads don't survive fork, so every forked worker starts its own one.
+    The first digest is built by the first lookup, so starting doesn't touch the database
+    """
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return
+    with _scheduler_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = threading.Thread(
+                target=_run_scheduler, name="digest", daemon=True
+            )
+            _scheduler.start()
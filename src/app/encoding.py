@@ -0,0 +1,98 @@
+"""Response encodings negotiated with the client
+
+JSON responses are sent as MessagePack to clients preferring `application/msgpack`
+in `Accept`. Responses larger than `[Encoding] min_size` bytes are compressed with
+brotli or gzip, as allowed by `Accept-Encoding`. Brotli and MessagePack are offered
+only if `brotli` and `msgpack` packages are installed.
+
+Encoded responses get a suffix appended to their `ETag`, so every representation
+is revalidated separately. Streamed responses are sent as is.
+"""
+
+import gzip
+import json
+
+from flask import current_app, request
+
+from src.app import config
+from src.app.metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+MIN_SIZE = config.getint("Encoding", "min_size", fallback=1024)
+GZIP_LEVEL = config.getint("Encoding", "gzip_level", fallback=6)
+BROTLI_QUALITY = config.getint("Encoding", "brotli_quality", fallback=4)
+
+
+def wants_msgpack() -> bool:
+    """Check if the client prefers MessagePack to JSON"""
+    if msgpack is None:
+        return False
+    accept = request.accept_mimetypes
+    return max(map(accept.quality, MSGPACK_MIMETYPES)) > accept.quality(
+        "application/json"
+    )
+
+
+@timed("serialization")
+def to_msgpack(data) -> bytes:
+    return msgpack.packb(data)
+
+
+def _content_coding():
+    """Return the best content coding accepted by the client, or `None`"""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def _compress(data, coding) -> bytes:
+    if coding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encode_response(response):
+    """Convert JSON response to MessagePack and compress it, as the client accepts"""
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code in (204, 304):
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+
+    is_json = response.mimetype == current_app.json.mimetype
+    if is_json or response.mimetype in MSGPACK_MIMETYPES:
+        response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+
+    convert = is_json and wants_msgpack()
+    coding = _content_coding()
+    # Decided by the size before conversion, so the ETag doesn't depend on the body
+    if (response.content_length or 0) < MIN_SIZE:
+        coding = None
+    if not convert and coding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        suffixes = (["msgpack"] if convert else []) + ([coding] if coding else [])
+        response.set_etag("-".join([etag, *suffixes]), weak)
+        if request.if_none_match.contains_weak(response.get_etag()[0]):
+            return response.make_conditional(request)
+
+    if convert:
+        response.set_data(to_msgpack(json.loads(response.get_data())))
+        response.mimetype = MSGPACK_MIMETYPES[0]
+    if coding is not None:
+        response.set_data(_compress(response.get_data(), coding))
+        response.headers["Content-Encoding"] = coding
+    return response
@@ -1,11 +1,21 @@
 """Routes for basic usage of the API"""
 
+import codecs
 import datetime
 import logging
-
-from flask import Response, abort, jsonify, request
+from hashlib import sha256
+
+from flask import (
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from flask_jwt_extended import (
     create_access_token,
+    get_current_user,
     get_jwt_identity,
     jwt_required,
     set_access_cookies,
@@ -13,69 +23,197 @@ from flask_jwt_extended import (
 )
 from marshmallow import ValidationError
 from peewee import DoesNotExist, IntegrityError
-from playhouse.shortcuts import model_to_dict
 
-from src.app import app, config
-from src.app.models import Birthdays, Users, birthdays_schema
+from src.app import api, config, keys, replicas, stats
+from src.app.admission import admission_control
+from src.app.batch import MAX_BATCH_SIZE, apply_batch
+from src.app.cache import UserResponseCache
+from src.app.digest import digest, is_timezone
+from src.app.formats import FORMATS, MIMETYPES, export_csv, export_ics, import_birthdays
+from src.app.models import (
+    Birthdays,
+    BirthdaysSchema,
+    Users,
+    birthdays_schema,
+    day_of_year,
+    day_of_year_sql,
+    next_version,
+)
+from src.app.replicas import on_replica, read_replica
+from src.app.search import (
+    DEFAULT_SEARCH_LIMIT,
+    MAX_SEARCH_LIMIT,
+    search_birthdays,
+    search_query,
+)
+from src.app.serializers import (
+    birthday_to_dict,
+    json_response,
+    select_birthdays,
+    to_json,
+)
+from src.app.sync import changes_since, delete_birthdays, user_transaction
 from src.app.utils import (
     CustomError,
     PubicKeyError,
     _abort_error,
     _check_telegram_data,
     _decrypt,
+    users_cache,
 )
 
 JWT_EXPIRES_MINUTES = int(config.get("Main", "jwt_expires_minutes"))
 TELEGRAM_BOT_TOKEN = str(config.get("Main", "telegram_bot_token"))
+PUBLIC_KEY_MAX_AGE = config.getint("Keys", "public_max_age", fallback=3600)
+
+# Serialized birthdays of users as `(etag, body)`, by birthday id or `None` for the list
+# Filled from primary reads only, replicas may lag behind writes for longer
+# than the sticky window. Writes handled by other workers are seen after `ttl`
+birthdays_cache = UserResponseCache(
+    config.getint("Cache", "birthdays_cache_size", fallback=1024),
+    ttl=config.getint("Cache", "birthdays_cache_ttl", fallback=30),
+)
+
+
+partial_birthdays_schema = BirthdaysSchema(partial=True)
+
+# Birthday columns returned by writes, creator is taken from the current user
+RETURNED_COLUMNS = (
+    Birthdays.id,
+    Birthdays.name,
+    Birthdays.day,
+    Birthdays.month,
+    Birthdays.year,
+    Birthdays.note,
+)
+
+
+def _returned_to_dict(row, user) -> dict:
+    """Convert a row of `RETURNED_COLUMNS` of the user's birthday to a dictionary"""
+    return birthday_to_dict((*row, user.telegram_id, user.language))
+
+
+def _update_returning(user, id, **values):
+    """Update the user's birthday in one statement and return its new row
+
+    Raises `DoesNotExist` if the user has no birthday with this id
+    """
+    rows = (
+        Birthdays.update(**values, version=next_version())
+        .where((Birthdays.creator == user) & (Birthdays.id == id))
+        .returning(*RETURNED_COLUMNS)
+        .tuples()
+        .execute()
+    )
+    if not rows:
+        raise DoesNotExist
+    return rows[0]
+
+
+def _birthdays_changed(telegram_id):
+    """Drop derived data of the user, should be called after every write"""
+    birthdays_cache.invalidate(telegram_id)
+    digest.mark_stale(telegram_id)
+    replicas.mark_written(telegram_id)
+    stats.mark_stale()
+
+
+def _to_cached(data):
+    """Serialize data to `(etag, body)` the same way `jsonify` does"""
+    body = (to_json(data) + "\n").encode("utf-8")
+    return sha256(body).hexdigest(), body
+
+
+def _cached_response(cached):
+    """Return cached `(etag, body)` as a response, `304` if client has it already"""
+    etag, body = cached
+    response = current_app.response_class(body, mimetype=current_app.json.mimetype)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
-@app.route("/public-key")
+def _stream_export(exporter, telegram_id):
+    """Yield the user's birthdays exported by the exporter"""
+    # Runs after the route has returned and left `read_replica`, choose the replica here
+    with on_replica(telegram_id):
+        yield from exporter(telegram_id)
+
+
+@api.route("/public-key")
 def public_key():
     """Return the public key for the client
 
-    This key is for encrypting the bot token before sending it to the server
+    This key is for encrypting the bot token before sending it to the server.
+    Response has an `ETag`, so clients can revalidate it with `If-None-Match`
     """
     try:
-        with open(config.get("Keys", "public"), "rb") as f:
-            pem = f.read()
-
-        pem_str = pem.decode("utf-8")
+        pem_str, etag = keys.public_key.get()
         logging.info("Public key sent")
 
-        return jsonify({"public_key": pem_str})
+        response = jsonify({"public_key": pem_str})
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = PUBLIC_KEY_MAX_AGE
+        return response.make_conditional(request)
 
     except Exception as error:
-        logging.error(f"Request: {request} Error: {error}")
+        logging.error("Request: %s Error: %s", request.url, error)
         _abort_error(error)
 
 
-@app.route("/login")
+@api.route("/login")
+@admission_control("login")
 def user_login():
     """Login endpoint for the user
 
-    Request args should have user's id and either bot's encrypted id or data from telegram's login widget
+    Request args should have user's id and either bot's encrypted id or data from telegram's login widget.
+    Optional `timezone` arg sets user's IANA time zone, e.g. `Europe/Berlin`,
+    reminder digests are built for the user's local date. Default time zone is UTC
 
     Returns a JWT token in cookies, should be used for further requests.
     Also CSRF token should be manually set in headers for further requests
     """
     try:
-        logging.info(f"Login request received with args: {request.args.to_dict()}")
+        logging.info("Login request received with args: %s", request.args)
+        telegram_data = request.args.to_dict()
+        # Not signed by Telegram, applied after the check
+        timezone = telegram_data.pop("timezone", None)
 
         if request.args.get("encrypted_bot_id"):
             logging.info("Decrypting bot id")
             received_bot_token = _decrypt(request.args.get("encrypted_bot_id"))
             if received_bot_token != TELEGRAM_BOT_TOKEN:
-                logging.warning(f"Invalid bot id: {received_bot_token}")
+                logging.warning("Invalid bot id: %s", received_bot_token)
                 abort(403, description="Invalid bot id")
-        elif not _check_telegram_data(request.args.to_dict()):
+        elif not _check_telegram_data(telegram_data):
             logging.warning(
-                f"Telegram data validation failed. Request.args: {request.args.to_dict()}"
+                "Telegram data validation failed. Request.args: %s",
+                request.args,
             )
             abort(412, description="Bad credentials")
 
-        user, created = Users.get_or_create(telegram_id=request.args.get("id"))
+        if timezone is not None and not is_timezone(timezone):
+            abort(400, description="Unknown time zone")
+
+        user, created = Users.get_or_create(
+            telegram_id=request.args.get("id"),
+            defaults={"timezone": timezone} if timezone is not None else {},
+        )
         if created:
-            logging.info(f"New user created with telegram_id: {user.telegram_id}")
+            logging.info("New user created with telegram_id: %s", user.telegram_id)
+            stats.mark_stale()
+        elif timezone is not None and user.timezone != timezone:
+            Users.update(timezone=timezone).where(
+                Users.telegram_id == user.telegram_id
+            ).execute()
+            user.timezone = timezone
+            digest.mark_stale(user.telegram_id)
+            logging.info(
+                "Time zone of user with telegram_id: %s set to %s",
+                user.telegram_id,
+                timezone,
+            )
+        users_cache.set(user.telegram_id, user)
 
         identity = {"telegram_id": user.telegram_id}
         jwt_token = create_access_token(
@@ -86,18 +224,18 @@ def user_login():
         response = Response(status=200)
         set_access_cookies(response, jwt_token)
         logging.info(
-            f"JWT token generated and cookies set for telegram_id: {user.telegram_id}"
+            "JWT token generated and cookies set for telegram_id: %s", user.telegram_id
         )
         return response
     except PubicKeyError:
         logging.error("Decryption failed: Invalid public key")
         abort(422, description="Decryption failed: Invalid public key")
     except Exception as error:
-        logging.error(f"Request: {request.args.to_dict()} Error: {error}")
+        logging.error("Request: %s Error: %s", request.args, error)
         _abort_error(error)
 
 
-@app.route("/logout")
+@api.route("/logout")
 @jwt_required()
 def logout():
     """Logout endpoint for the user"""
@@ -107,71 +245,191 @@ def logout():
         logging.info("JWT cookies unset")
         return response
     except Exception as error:
-        logging.error(f"Error during logout: {error}")
+        logging.error("Error during logout: %s", error)
         _abort_error(error)
 
 
-@app.route("/birthdays", methods=["GET"])
+@api.route("/birthdays", methods=["GET"])
 @jwt_required()
+@read_replica
 def users_birthdays():
-    """Get all birthdays of the user"""
+    """Get all birthdays of the user
+
+    Response has an `ETag`, unchanged list is not sent again for matching `If-None-Match`.
+
+    Request args can have `since` - version of the last sync, then only changes are
+    returned as a JSON with the following fields:
+    - version: `int`, version to send as `since` next time
+    - birthdays: list of added and updated birthdays
+    - deleted: list of ids of deleted birthdays, empty for `since=0`
+    """
     try:
         current_user = get_jwt_identity()
         logging.info(
-            f"Fetching birthdays for user with telegram_id: {current_user['telegram_id']}"
+            "Fetching birthdays for user with telegram_id: %s",
+            current_user["telegram_id"],
         )
 
-        user = Users.get(telegram_id=current_user["telegram_id"])
-        birthdays = Users.get(Users.telegram_id == user.telegram_id).birthdays
+        if "since" in request.args:
+            since = request.args.get("since", type=int)
+            if since is None or since < 0:
+                abort(400, description="Since should be a non-negative version")
+            changes = changes_since(current_user["telegram_id"], since)
+            logging.info(
+                "Found %s changed and %s deleted birthdays since version %s",
+                len(changes["birthdays"]),
+                len(changes["deleted"]),
+                since,
+            )
+            return json_response(changes), 200
+
+        cached = birthdays_cache.get(current_user["telegram_id"], None)
+        if cached is not None:
+            logging.info(
+                "Cached birthdays found for user with telegram_id: %s",
+                current_user["telegram_id"],
+            )
+            return _cached_response(cached)
+
+        entries = birthdays_cache.entries(current_user["telegram_id"])
+        birthdays = (
+            select_birthdays()
+            .where(Birthdays.creator == current_user["telegram_id"])
+            .order_by(Birthdays.id)
+        )
 
-        data = [model_to_dict(birthday) for birthday in birthdays]
+        data = [birthday_to_dict(row) for row in birthdays]
         if not data:
             logging.warning(
-                f"No birthdays found for user with telegram_id: {current_user['telegram_id']}"
+                "No birthdays found for user with telegram_id: %s",
+                current_user["telegram_id"],
             )
             abort(404, description="There are no birthdays for this user")
 
         logging.info(
-            f"Found {len(data)} birthdays for user with telegram_id: {current_user['telegram_id']}"
+            "Found %s birthdays for user with telegram_id: %s",
+            len(data),
+            current_user["telegram_id"],
+        )
+        cached = _to_cached(data)
+        if replicas.on_primary():
+            birthdays_cache.set(current_user["telegram_id"], None, cached, entries)
+        return _cached_response(cached)
+    except Exception as error:
+        logging.error(
+            "Error fetching birthdays for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
+        )
+        _abort_error(error)
+
+
+@api.route("/birthdays/search", methods=["GET"])
+@jwt_required()
+@read_replica
+def search_birthdays_endpoint():
+    """Search birthdays of the user by name and note
+
+    Request args should have `q` - words to search for, each matched as a prefix.
+    Can have `limit` - maximum number of returned birthdays, defaults to 20
+
+    Returns birthdays ordered from the best match
+    """
+    try:
+        current_user = get_jwt_identity()
+        text = request.args.get("q", "")
+        limit = request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int)
+        if not search_query(text) or len(text) > 255:
+            abort(400, description="Search string should have words")
+        if not 0 < limit <= MAX_SEARCH_LIMIT:
+            abort(400, description=f"Limit should be within 1..{MAX_SEARCH_LIMIT}")
+
+        logging.info(
+            "Searching birthdays for user with telegram_id: %s, Query: %s",
+            current_user["telegram_id"],
+            text,
         )
-        return jsonify(data), 200
+
+        data = search_birthdays(current_user["telegram_id"], text, limit)
+        if not data:
+            logging.info(
+                "No birthdays match the query for user with telegram_id: %s",
+                current_user["telegram_id"],
+            )
+            abort(404, description="No birthdays match the query")
+
+        return json_response(data), 200
     except Exception as error:
         logging.error(
-            f"Error fetching birthdays for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Error searching birthdays for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
         )
         _abort_error(error)
 
 
-@app.route("/birthdays/<int:id>", methods=["GET"])
+@api.route("/birthdays/<int:id>", methods=["GET"])
 @jwt_required()
+@read_replica
 def one_birthday(id):
-    """Get one birthday of the user by id"""
+    """Get one birthday of the user by id
+
+    Response has an `ETag`, unchanged birthday is not sent again for matching `If-None-Match`
+    """
     try:
         current_user = get_jwt_identity()
         logging.info(
-            f"Fetching birthday with id {id} for user with telegram_id: {current_user['telegram_id']}"
+            "Fetching birthday with id %s for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
 
-        user = Users.get(telegram_id=current_user["telegram_id"])
-        birthday = Birthdays.get((Birthdays.creator == user) & (Birthdays.id == id))
+        cached = birthdays_cache.get(current_user["telegram_id"], id)
+        if cached is not None:
+            logging.info(
+                "Cached birthday with id %s found for user with telegram_id: %s",
+                id,
+                current_user["telegram_id"],
+            )
+            return _cached_response(cached)
+
+        entries = birthdays_cache.entries(current_user["telegram_id"])
+        birthday = (
+            select_birthdays()
+            .where(
+                (Birthdays.creator == current_user["telegram_id"])
+                & (Birthdays.id == id)
+            )
+            .get()
+        )
 
         logging.info(
-            f"Birthday with id {id} found for user with telegram_id: {current_user['telegram_id']}"
+            "Birthday with id %s found for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
-        return jsonify(model_to_dict(birthday)), 200
+        cached = _to_cached(birthday_to_dict(birthday))
+        if replicas.on_primary():
+            birthdays_cache.set(current_user["telegram_id"], id, cached, entries)
+        return _cached_response(cached)
     except DoesNotExist:
         logging.warning(
-            f"Birthday with id {id} not found for user with telegram_id: {current_user['telegram_id']}"
+            "Birthday with id %s not found for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
         abort(404, description="Birthday not found")
     except Exception as error:
         logging.error(
-            f"Error fetching birthday with id {id} for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Error fetching birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
         )
         _abort_error(error)
 
 
-@app.route("/birthdays", methods=["POST"])
+@api.route("/birthdays", methods=["POST"])
 @jwt_required()
 def add_birthday():
     """Add a new birthday for the user
@@ -186,30 +444,44 @@ def add_birthday():
     Returns the added birthday with its id
     """
     try:
-        data = birthdays_schema.load(request.get_json())
         current_user = get_jwt_identity()
+        data = birthdays_schema.load(request.get_json())
         logging.info(
-            f"Adding birthday for user with telegram_id: {current_user['telegram_id']}, Data: {data}"
+            "Adding birthday for user with telegram_id: %s, Data: %s",
+            current_user["telegram_id"],
+            data,
         )
 
-        user = Users.get(telegram_id=current_user["telegram_id"])
-        birthday_id = Birthdays.create(
-            name=data.get("name"),
-            day=data.get("day"),
-            month=data.get("month"),
-            year=data.get("year"),
-            note=data.get("note"),
-            creator=user,
-        )
+        user = get_current_user()
+        with user_transaction(user):
+            birthday = (
+                Birthdays.insert(
+                    name=data.get("name"),
+                    day=data.get("day"),
+                    month=data.get("month"),
+                    year=data.get("year"),
+                    note=data.get("note"),
+                    day_of_year=day_of_year(data.get("month"), data.get("day")),
+                    creator=user,
+                )
+                .returning(*RETURNED_COLUMNS)
+                .tuples()
+                .execute()[0]
+            )
+        _birthdays_changed(current_user["telegram_id"])
 
         logging.info(
-            f"Birthday with id {birthday_id} added for user with telegram_id: {current_user['telegram_id']}"
+            "Birthday with id %s added for user with telegram_id: %s",
+            birthday[0],
+            current_user["telegram_id"],
         )
-        response = jsonify(model_to_dict(Birthdays.get_by_id(birthday_id)))
+        response = json_response(_returned_to_dict(birthday, user))
         return response, 201
     except ValidationError as error:
         logging.warning(
-            f"Validation error adding birthday for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Validation error adding birthday for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
         )
         try:
             raise CustomError(
@@ -219,50 +491,212 @@ def add_birthday():
             abort(422, description="Unprocessable birthday data")
     except IntegrityError:
         logging.warning(
-            f"Integrity error: User with telegram_id: {current_user['telegram_id']} already has a birthday with this name"
+            "Integrity error: User with telegram_id: %s already has a birthday with this name",
+            current_user["telegram_id"],
         )
         raise CustomError(
             422, description="User already has a birthday with this name", field="name"
         )
     except Exception as error:
         logging.error(
-            f"Error adding birthday for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Error adding birthday for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
         )
         _abort_error(error)
 
 
-@app.route("/birthdays/<int:id>", methods=["DELETE"])
+@api.route("/birthdays/batch", methods=["POST"])
+@jwt_required()
+def batch_birthdays():
+    """Create, update and delete many birthdays of the user in one transaction
+
+    Request should have a JSON list of operations:
+    - `{"op": "create", "birthday": {...}}`
+    - `{"op": "update", "id": int, "birthday": {...}}`
+    - `{"op": "delete", "id": int}`
+
+    Birthdays have the same fields as in `POST /birthdays`
+
+    Returns a list of results in the same order, each with `status` and either
+    the `birthday` or error `description` and `field`.
+    Failed operations are skipped, the rest are applied
+    """
+    try:
+        current_user = get_jwt_identity()
+        operations = request.get_json()
+        if not isinstance(operations, list) or not operations:
+            abort(400, description="Request should have a list of operations")
+        if len(operations) > MAX_BATCH_SIZE:
+            abort(
+                400, description=f"Batch can have at most {MAX_BATCH_SIZE} operations"
+            )
+
+        logging.info(
+            "Applying %s operations for user with telegram_id: %s",
+            len(operations),
+            current_user["telegram_id"],
+        )
+
+        user = get_current_user()
+        results = apply_batch(user, operations)
+        _birthdays_changed(current_user["telegram_id"])
+
+        logging.info(
+            "Applied batch for user with telegram_id: %s", current_user["telegram_id"]
+        )
+        return json_response(results), 200
+    except IntegrityError:
+        logging.warning(
+            "Integrity error applying batch for user with telegram_id: %s",
+            current_user["telegram_id"],
+        )
+        raise CustomError(
+            422, description="User already has a birthday with this name", field="name"
+        )
+    except Exception as error:
+        logging.error(
+            "Error applying batch for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
+        )
+        _abort_error(error)
+
+
+@api.route("/birthdays/export", methods=["GET"])
+@jwt_required()
+@read_replica
+def export_birthdays():
+    """Export all birthdays of the user as a file
+
+    Request args can have `format` - `csv` (default) or `ics`.
+    Birthdays are streamed, not loaded into memory at once
+    """
+    try:
+        current_user = get_jwt_identity()
+        format = request.args.get("format", "csv")
+        if format not in FORMATS:
+            abort(400, description=f"Format should be one of: {', '.join(FORMATS)}")
+
+        logging.info(
+            "Exporting birthdays as %s for user with telegram_id: %s",
+            format,
+            current_user["telegram_id"],
+        )
+
+        exporter = export_csv if format == "csv" else export_ics
+        response = Response(
+            stream_with_context(_stream_export(exporter, current_user["telegram_id"])),
+            mimetype=MIMETYPES[format],
+        )
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename=birthdays.{format}"
+        )
+        return response
+    except Exception as error:
+        logging.error(
+            "Error exporting birthdays for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
+        )
+        _abort_error(error)
+
+
+@api.route("/birthdays/import", methods=["POST"])
+@jwt_required()
+def import_birthdays_file():
+    """Import birthdays of the user from a file
+
+    Request should have the file either as multipart `file` field or as the body.
+    Format is taken from `format` request arg - `csv` or `ics`, or from the file extension.
+    CSV should have a header with `name`, `day`, `month`, `year` and `note` columns.
+    Birthdays with names the user already has are skipped
+
+    Returns counts of imported, skipped and invalid birthdays along with validation errors
+    """
+    try:
+        current_user = get_jwt_identity()
+        file = request.files.get("file")
+        extension = file.filename.rpartition(".")[2].lower() if file else None
+        format = request.args.get("format") or (
+            extension if extension in FORMATS else "csv"
+        )
+        if format not in FORMATS:
+            abort(400, description=f"Format should be one of: {', '.join(FORMATS)}")
+
+        logging.info(
+            "Importing birthdays from %s for user with telegram_id: %s",
+            format,
+            current_user["telegram_id"],
+        )
+
+        user = get_current_user()
+        stream = codecs.getreader("utf-8-sig")(file.stream if file else request.stream)
+        result = import_birthdays(user, stream, format)
+        _birthdays_changed(current_user["telegram_id"])
+
+        logging.info(
+            "Imported %s birthdays for user with telegram_id: %s",
+            result["imported"],
+            current_user["telegram_id"],
+        )
+        return jsonify(result), 200
+    except UnicodeDecodeError:
+        logging.warning(
+            "Import file of user with telegram_id: %s is not UTF-8",
+            current_user["telegram_id"],
+        )
+        abort(400, description="File should be UTF-8 encoded")
+    except Exception as error:
+        logging.error(
+            "Error importing birthdays for user with telegram_id: %s, Error: %s",
+            current_user["telegram_id"],
+            error,
+        )
+        _abort_error(error)
+
+
+@api.route("/birthdays/<int:id>", methods=["DELETE"])
 @jwt_required()
 def delete_birthday(id):
     """Delete a birthday by id"""
     try:
         current_user = get_jwt_identity()
         logging.info(
-            f"Deleting birthday with id {id} for user with telegram_id: {current_user['telegram_id']}"
+            "Deleting birthday with id %s for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
 
-        user = Users.get(telegram_id=current_user["telegram_id"])
-        Birthdays.get(
-            (Birthdays.creator == user) & (Birthdays.id == id)
-        ).delete_instance()
+        user = get_current_user()
+        if not delete_birthdays(user, Birthdays.id == id):
+            raise DoesNotExist
+        _birthdays_changed(current_user["telegram_id"])
 
         logging.info(
-            f"Birthday with id {id} deleted for user with telegram_id: {current_user['telegram_id']}"
+            "Birthday with id %s deleted for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
         return Response(status=204)
     except DoesNotExist:
         logging.warning(
-            f"Attempted to delete non-existent birthday with id {id} for user with telegram_id: {current_user['telegram_id']}"
+            "Attempted to delete non-existent birthday with id %s for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
         abort(404, description="Can't delete non-existent birthday")
     except Exception as error:
         logging.error(
-            f"Error deleting birthday with id {id} for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Error deleting birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
         )
         _abort_error(error)
 
 
-@app.route("/birthdays/<int:id>", methods=["PUT"])
+@api.route("/birthdays/<int:id>", methods=["PUT"])
 @jwt_required()
 def update_birthday(id):
     """Rewrite a birthday by id
@@ -277,29 +711,125 @@ def update_birthday(id):
     Returns the updated birthday with its id
     """
     try:
+        current_user = get_jwt_identity()
         data = birthdays_schema.load(request.get_json())
+        logging.info(
+            "Updating birthday with id %s for user with telegram_id: %s, Data: %s",
+            id,
+            current_user["telegram_id"],
+            data,
+        )
+
+        user = get_current_user()
+        with user_transaction(user):
+            birthday = _update_returning(
+                user,
+                id,
+                name=data.get("name"),
+                day=data.get("day"),
+                month=data.get("month"),
+                year=data.get("year"),
+                note=data.get("note"),
+                day_of_year=day_of_year(data.get("month"), data.get("day")),
+            )
+        _birthdays_changed(current_user["telegram_id"])
+
+        logging.info(
+            "Birthday with id %s updated for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
+        )
+        response = json_response(_returned_to_dict(birthday, user))
+        return response, 200
+    except ValidationError as error:
+        logging.warning(
+            "Validation error updating birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
+        )
+        try:
+            raise CustomError(
+                422, description="\n".join(error.messages_dict["_schema"]), field="date"
+            )
+        except KeyError:
+            abort(422, description="Unprocessable birthday data")
+    except IntegrityError:
+        logging.warning(
+            "Integrity error: User with telegram_id: %s already has a birthday with this name",
+            current_user["telegram_id"],
+        )
+        raise CustomError(
+            422, description="User already has a birthday with this name", field="name"
+        )
+    except DoesNotExist:
+        logging.warning(
+            "Attempted to update non-existent birthday with id %s for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
+        )
+        abort(404, description="Can't update non-existent birthday")
+    except Exception as error:
+        logging.error(
+            "Error updating birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
+        )
+        _abort_error(error)
+
+
+@api.route("/birthdays/<int:id>", methods=["PATCH"])
+@jwt_required()
+def patch_birthday(id):
+    """Update only the sent fields of a birthday by id
+
+    Request should have a JSON with any of the fields of `PUT /birthdays/<id>`.
+    Date is validated together with the stored fields, in the same transaction
+
+    Returns the updated birthday with its id
+    """
+    try:
         current_user = get_jwt_identity()
+        data = partial_birthdays_schema.load(request.get_json())
         logging.info(
-            f"Updating birthday with id {id} for user with telegram_id: {current_user['telegram_id']}, Data: {data}"
+            "Patching birthday with id %s for user with telegram_id: %s, Data: %s",
+            id,
+            current_user["telegram_id"],
+            data,
         )
+        if not data:
+            abort(400, description="Request should have at least one field to update")
 
-        user = Users.get(telegram_id=current_user["telegram_id"])
-        Birthdays.update(
-            name=data.get("name"),
-            day=data.get("day"),
-            month=data.get("month"),
-            year=data.get("year"),
-            note=data.get("note"),
-        ).where((Birthdays.creator == user) & (Birthdays.id == id)).execute()
+        if "month" in data or "day" in data:
+            data["day_of_year"] = day_of_year_sql(
+                data.get("month", Birthdays.month), data.get("day", Birthdays.day)
+            )
+
+        user = get_current_user()
+        with user_transaction(user):
+            birthday = _update_returning(user, id, **data)
+            errors = birthdays_schema.validate(
+                dict(zip(("name", "day", "month", "year", "note"), birthday[1:]))
+            )
+            if errors:
+                # Raising rolls the update back
+                raise ValidationError(errors)
+        _birthdays_changed(current_user["telegram_id"])
 
         logging.info(
-            f"Birthday with id {id} updated for user with telegram_id: {current_user['telegram_id']}"
+            "Birthday with id %s patched for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
-        response = jsonify(model_to_dict(Birthdays.get_by_id(id)))
+        response = json_response(_returned_to_dict(birthday, user))
         return response, 200
     except ValidationError as error:
         logging.warning(
-            f"Validation error updating birthday with id {id} for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Validation error patching birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
         )
         try:
             raise CustomError(
@@ -309,18 +839,24 @@ def update_birthday(id):
             abort(422, description="Unprocessable birthday data")
     except IntegrityError:
         logging.warning(
-            f"Integrity error: User with telegram_id: {current_user['telegram_id']} already has a birthday with this name"
+            "Integrity error: User with telegram_id: %s already has a birthday with this name",
+            current_user["telegram_id"],
         )
         raise CustomError(
             422, description="User already has a birthday with this name", field="name"
         )
     except DoesNotExist:
         logging.warning(
-            f"Attempted to update non-existent birthday with id {id} for user with telegram_id: {current_user['telegram_id']}"
+            "Attempted to patch non-existent birthday with id %s for user with telegram_id: %s",
+            id,
+            current_user["telegram_id"],
         )
         abort(404, description="Can't update non-existent birthday")
     except Exception as error:
         logging.error(
-            f"Error updating birthday with id {id} for user with telegram_id: {current_user['telegram_id']}, Error: {error}"
+            "Error patching birthday with id %s for user with telegram_id: %s, Error: %s",
+            id,
+            current_user["telegram_id"],
+            error,
         )
         _abort_error(error)
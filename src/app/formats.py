@@ -0,0 +1,229 @@
+"""CSV and iCalendar import and export of a user's birthdays
+
+Export walks the user's birthdays in keyset batches and yields serialized rows,
+import parses the file lazily and writes it in chunks with bulk inserts,
+so both run in constant memory regardless of the number of birthdays.
+"""
+
+import csv
+import datetime
+import io
+
+from marshmallow import ValidationError
+
+from src.app.models import Birthdays, birthdays_schema, day_of_year
+from src.app.sync import user_transaction
+
+FORMATS = ("csv", "ics")
+MIMETYPES = {"csv": "text/csv", "ics": "text/calendar"}
+CSV_FIELDS = ("name", "day", "month", "year", "note")
+
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+
+# iCalendar events need a full date, birthdays without year are exported in this one
+ICS_UNKNOWN_YEAR = 2000
+ICS_UNKNOWN_YEAR_PROPERTY = "X-BIRTHDAY-YEAR-UNKNOWN"
+
+
+def _user_birthdays(user):
+    """Yield `(id, name, day, month, year, note)` of user's birthdays in batches"""
+    after_id = 0
+    while True:
+        count = 0
+        for row in (
+            Birthdays.select(
+                Birthdays.id,
+                Birthdays.name,
+                Birthdays.day,
+                Birthdays.month,
+                Birthdays.year,
+                Birthdays.note,
+            )
+            .where((Birthdays.creator == user) & (Birthdays.id > after_id))
+            .order_by(Birthdays.id)
+            .limit(BATCH_SIZE)
+            .tuples()
+            .iterator()
+        ):
+            count += 1
+            after_id = row[0]
+            yield row
+        if count < BATCH_SIZE:
+            return
+
+
+def _csv_line(values) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+
+def export_csv(user):
+    """Yield user's birthdays as CSV lines with a header"""
+    yield _csv_line(CSV_FIELDS)
+    for _, name, day, month, year, note in _user_birthdays(user):
+        yield _csv_line((name, day, month, "" if year is None else year, note or ""))
+
+
+def _ics_escape(value) -> str:
+    return (
+        value.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def _ics_unescape(value) -> str:
+    result = []
+    characters = iter(value)
+    for character in characters:
+        if character == "\\":
+            character = next(characters, "")
+            character = "\n" if character in "nN" else character
+        result.append(character)
+    return "".join(result)
+
+
+def _ics_line(line) -> str:
+    """Fold a content line to at most 75 octets per line"""
+    encoded = line.encode("utf-8")
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        while cut and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+    parts.append(encoded.decode("utf-8"))
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def export_ics(user):
+    """Yield user's birthdays as a calendar of yearly all-day events"""
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield _ics_line("BEGIN:VCALENDAR")
+    yield _ics_line("VERSION:2.0")
+    yield _ics_line("PRODID:-//birthday-api//EN")
+    for id, name, day, month, year, note in _user_birthdays(user):
+        start = datetime.date(year or ICS_UNKNOWN_YEAR, month, day)
+        yield _ics_line("BEGIN:VEVENT")
+        yield _ics_line(f"UID:{id}@birthday-api")
+        yield _ics_line(f"DTSTAMP:{stamp}")
+        yield _ics_line(f"DTSTART;VALUE=DATE:{start:%Y%m%d}")
+        yield _ics_line("RRULE:FREQ=YEARLY")
+        yield _ics_line(f"SUMMARY:{_ics_escape(name)}")
+        if note:
+            yield _ics_line(f"DESCRIPTION:{_ics_escape(note)}")
+        if year is None:
+            yield _ics_line(f"{ICS_UNKNOWN_YEAR_PROPERTY}:TRUE")
+        yield _ics_line("END:VEVENT")
+    yield _ics_line("END:VCALENDAR")
+
+
+def _read_csv(stream):
+    """Yield birthdays from CSV lines with a header"""
+    for row in csv.DictReader(stream):
+        yield {
+            "name": row.get("name"),
+            "day": row.get("day"),
+            "month": row.get("month"),
+            "year": row.get("year") or None,
+            "note": row.get("note") or None,
+        }
+
+
+def _unfolded_lines(stream):
+    """Yield iCalendar content lines with folded continuations joined"""
+    line = None
+    for raw_line in stream:
+        raw_line = raw_line.rstrip("\r\n")
+        if raw_line[:1] in (" ", "\t") and line is not None:
+            line += raw_line[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw_line
+    if line is not None:
+        yield line
+
+
+def _read_ics(stream):
+    """Yield birthdays from events of a calendar
+
+    Events should have `SUMMARY` and an all-day `DTSTART`
+    """
+    event = None
+    for line in _unfolded_lines(stream):
+        name, _, value = line.partition(":")
+        name = name.split(";")[0].upper()
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            event = {}
+        elif name == "END" and value.upper() == "VEVENT" and event is not None:
+            start = event.get("DTSTART", "")[:8]
+            year_unknown = event.get(ICS_UNKNOWN_YEAR_PROPERTY, "").upper() == "TRUE"
+            yield {
+                "name": _ics_unescape(event.get("SUMMARY", "")) or None,
+                "day": start[6:8] or None,
+                "month": start[4:6] or None,
+                "year": None if year_unknown else start[:4] or None,
+                "note": _ics_unescape(event.get("DESCRIPTION", "")) or None,
+            }
+            event = None
+        elif event is not None:
+            event[name] = value
+
+
+def _insert_chunk(user, birthdays) -> int:
+    """Insert birthdays skipping names the user already has, return inserted count"""
+    rows = [
+        {
+            **birthday,
+            "day_of_year": day_of_year(birthday["month"], birthday["day"]),
+            "creator": user,
+        }
+        for birthday in birthdays
+    ]
+    query = (
+        Birthdays.insert_many(rows)
+        .on_conflict_ignore()
+        .returning(Birthdays.id)
+        .tuples()
+    )
+    return len(query.execute())
+
+
+def import_birthdays(user, stream, format) -> dict:
+    """Validate and insert birthdays from a text stream in chunks
+
+    Rows are validated with `BirthdaysSchema`, invalid ones are reported.
+    Rows with names the user already has are skipped.
+    All rows are inserted in one transaction
+    """
+    rows = _read_csv(stream) if format == "csv" else _read_ics(stream)
+    result = {"imported": 0, "skipped": 0, "invalid": 0, "errors": []}
+
+    def flush(chunk):
+        imported = _insert_chunk(user, chunk)
+        result["imported"] += imported
+        result["skipped"] += len(chunk) - imported
+
+    with user_transaction(user):
+        chunk = []
+        for number, row in enumerate(rows, start=1):
+            try:
+                chunk.append(birthdays_schema.load(row))
+            except ValidationError as error:
+                result["invalid"] += 1
+                if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                    result["errors"].append({"row": number, "messages": error.messages})
+                continue
+            if len(chunk) == BATCH_SIZE:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+
+    return result
@@ -0,0 +1,96 @@
+"""Lookup of incoming birthdays over the precomputed day-of-year key
+
+A look-ahead window is a set of day offsets from today. Offsets are turned into
+day-of-year keys, the keys are collapsed into contiguous ranges and the whole window
+is answered with a single query over the indexed `Birthdays.day_of_year` column.
+"""
+
+import datetime
+import operator
+from functools import reduce
+
+from src.app.models import Birthdays, day_of_year
+from src.app.serializers import birthday_to_dict, select_birthdays
+
+DEFAULT_WINDOW = "0,1,7"
+MAX_DAYS_AHEAD = 365
+
+
+def parse_window(value) -> list:
+    """Parse a look-ahead window into a sorted list of day offsets
+
+    Window is a comma separated list of offsets and inclusive ranges,
+    e.g. `0,1,7` or `0..30`. Raises `ValueError` if the window is invalid.
+    """
+    offsets = set()
+    for part in value.split(","):
+        start, separator, end = part.strip().partition("..")
+        start = int(start)
+        end = int(end) if separator else start
+        if not 0 <= start <= end <= MAX_DAYS_AHEAD:
+            raise ValueError(f"Offsets should be within 0..{MAX_DAYS_AHEAD}")
+        offsets.update(range(start, end + 1))
+    return sorted(offsets)
+
+
+def window_keys(offsets, today) -> dict:
+    """Map day-of-year keys to the closest offset they are incoming in
+
+    February 29 is skipped, since there are no birthdays on that date.
+    """
+    keys = {}
+    for offset in offsets:
+        incoming_in = today + datetime.timedelta(days=offset)
+        if (incoming_in.month, incoming_in.day) == (2, 29):
+            continue
+        keys.setdefault(day_of_year(incoming_in.month, incoming_in.day), offset)
+    return keys
+
+
+def _key_ranges(keys):
+    """Collapse keys into inclusive `(first, last)` ranges of consecutive keys"""
+    ranges = []
+    for key in sorted(keys):
+        if ranges and ranges[-1][1] == key - 1:
+            ranges[-1][1] = key
+        else:
+            ranges.append([key, key])
+    return ranges
+
+
+def keys_condition(keys):
+    """Return a condition matching birthdays with any of the day-of-year keys
+
+    Keys should not be empty
+    """
+    return reduce(
+        operator.or_,
+        [
+            (
+                Birthdays.day_of_year == first
+                if first == last
+                else Birthdays.day_of_year.between(first, last)
+            )
+            for first, last in _key_ranges(keys)
+        ],
+    )
+
+
+def find_incoming(offsets, today=None) -> list:
+    """Return serialized birthdays within the window
+
+    Every birthday has `incoming_in_days` set to the offset it is incoming in.
+    Windows crossing New Year are split into several ranges of the same query.
+    Result is ordered by `incoming_in_days` and then by id.
+    """
+    keys = window_keys(offsets, today or datetime.date.today())
+    if not keys:
+        return []
+
+    data = []
+    for row in select_birthdays(Birthdays.day_of_year).where(keys_condition(keys)):
+        entry = birthday_to_dict(row)
+        entry["incoming_in_days"] = keys[row[-1]]
+        data.append(entry)
+    data.sort(key=lambda entry: (entry["incoming_in_days"], entry["id"]))
+    return data
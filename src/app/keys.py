@@ -0,0 +1,62 @@
+"""Key material for the encrypted bot id
+
+Keys are read from disk once and reloaded only when their files change.
+During rotation several private keys can be configured, separated by commas,
+decryption is attempted with each of them in order.
+"""
+
+import os
+import threading
+from hashlib import sha256
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from src.app import config
+from src.app.cache import LRUCache
+
+
+class KeyFile:
+    """Parsed contents of a key file, reloaded when the file is modified"""
+
+    def __init__(self, path, load):
+        self.path = path
+        self.version = 0
+        self._load = load
+        self._loaded = (None, None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if self._loaded[0] != mtime:
+            with self._lock:
+                if self._loaded[0] != mtime:
+                    with open(self.path, "rb") as f:
+                        value = self._load(f.read())
+                    self._loaded = (mtime, value)
+                    self.version += 1
+        return self._loaded[1]
+
+
+def _load_public(pem):
+    """Return public key as a string along with its ETag"""
+    return pem.decode("utf-8"), sha256(pem).hexdigest()
+
+
+def _load_private(pem):
+    return serialization.load_pem_private_key(
+        pem, password=None, backend=default_backend()
+    )
+
+
+public_key = KeyFile(config.get("Keys", "public"), _load_public)
+private_keys = [
+    KeyFile(path.strip(), _load_private)
+    for path in config.get("Keys", "private").split(",")
+]
+
+# Decrypted bot ids by ciphertext and versions of private keys
+decrypted_cache = LRUCache(
+    maxsize=config.getint("Keys", "decrypt_cache_size", fallback=128),
+    ttl=config.getint("Keys", "decrypt_cache_ttl", fallback=300),
+)
@@ -2,13 +2,30 @@
 
 Creates several log files with different levels in the logs directory above the current script's directory
 
+Records are put into a queue on the calling thread and written to files by a single
+background thread, so requests never wait for disk I/O or log rotation.
+Message arguments are merged on the calling thread, while they are still valid
+and request context is available; records are formatted by the writer thread.
+Use lazy `%`-style arguments instead of f-strings when logging, records below
+the configured level are never merged.
+
+Info and lower records can be sampled per endpoint in `[LogSampling]` config section,
+e.g. `users_birthdays = 0.1` keeps every tenth record logged while handling that endpoint.
+`format = json` in `[Logs]` section switches log files to JSON lines.
+
 For usage in the application, import this module in the main script.
 In all other scripts, use standard `logging` module to log messages.
 """
 
+import atexit
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import has_request_context, request
 
 from src.app import config
 
@@ -16,41 +33,119 @@ log_dir = config.get("Logs", "log_to")
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
 
 class ExcludeGetUpdatesFilter(logging.Filter):
     def filter(self, record):
         return "getUpdates" not in record.getMessage()
 
 
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s"
-)
+class EndpointSamplingFilter(logging.Filter):
+    """Keep only a share of info and lower records logged for each endpoint"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not has_request_context():
+            return True
+        # Endpoints are registered on a blueprint, rates are configured without its name
+        rate = self.rates.get((request.endpoint or "").rpartition(".")[2])
+        return rate is None or random.random() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON lines"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler which leaves formatting to the listener thread
+
+    Message arguments are merged in advance, like `QueueHandler` does: they may be
+    request proxies or objects changed after logging. Exception info is kept,
+    so the listener's formatters can still render tracebacks their own way
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+if config.get("Logs", "format", fallback="text") == "json":
+    formatter = JSONFormatter()
+else:
+    formatter = logging.Formatter(LOG_FORMAT)
+
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 
 info_handler = RotatingFileHandler(
     os.path.join(log_dir, "info.log"), maxBytes=5 * 1024 * 1024, backupCount=3
 )
 info_handler.setLevel(logging.INFO)
-info_handler.setFormatter(
-    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-)
+info_handler.setFormatter(formatter)
 info_handler.addFilter(ExcludeGetUpdatesFilter())
 
 warning_handler = RotatingFileHandler(
     os.path.join(log_dir, "warning.log"), maxBytes=5 * 1024 * 1024, backupCount=3
 )
 warning_handler.setLevel(logging.WARNING)
-warning_handler.setFormatter(
-    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-)
+warning_handler.setFormatter(formatter)
 
 error_handler = RotatingFileHandler(
     os.path.join(log_dir, "error.log"), maxBytes=5 * 1024 * 1024, backupCount=3
 )
 error_handler.setLevel(logging.ERROR)
-error_handler.setFormatter(
-    logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+error_handler.setFormatter(formatter)
+
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+if config.has_section("LogSampling"):
+    queue_handler.addFilter(
+        EndpointSamplingFilter(
+            {
+                endpoint: float(rate)
+                for endpoint, rate in config.items("LogSampling")
+                if endpoint not in config.defaults()
+            }
+        )
+    )
+
+listener = QueueListener(
+    log_queue,
+    console_handler,
+    info_handler,
+    warning_handler,
+    error_handler,
+    respect_handler_level=True,
 )
+listener.start()
+atexit.register(listener.stop)
+
+
+def _restart_listener():
+    """Start a new writer thread in a forked worker, threads don't survive fork"""
+    listener.queue = queue_handler.queue = queue.SimpleQueue()
+    listener._thread = None
+    listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
 
-logging.getLogger().addHandler(info_handler)
-logging.getLogger().addHandler(warning_handler)
-logging.getLogger().addHandler(error_handler)
+root_logger = logging.getLogger()
+root_logger.setLevel(config.get("Logs", "level", fallback="INFO").upper())
+root_logger.addHandler(queue_handler)
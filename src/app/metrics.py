@@ -0,0 +1,211 @@
+"""Request metrics in Prometheus text format
+
+Collects per-route latency, response status counts, number and duration
+of SQL queries per request, and durations of expensive operations
+such as decryption and serialization.
+"""
+
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request
+
+from src.app import api
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram with cumulative buckets and labels"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self) -> list:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = [
+                (labels, list(counts), total, count)
+                for labels, (counts, total, count) in sorted(self._values.items())
+            ]
+        for labels, counts, total, count in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+            bucket_labels = _format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+request_duration = Histogram(
+    "birthday_api_request_duration_seconds", "Time spent handling requests"
+)
+responses = Counter("birthday_api_responses_total", "Responses sent by status code")
+request_queries = Histogram(
+    "birthday_api_request_queries",
+    "SQL queries executed per request",
+    buckets=QUERY_COUNT_BUCKETS,
+)
+request_db_duration = Histogram(
+    "birthday_api_request_db_seconds", "Time spent executing SQL queries per request"
+)
+queries = Counter("birthday_api_db_queries_total", "SQL queries executed")
+operation_duration = Histogram(
+    "birthday_api_operation_duration_seconds",
+    "Time spent in expensive operations like decryption and serialization",
+)
+
+shed_requests = Counter(
+    "birthday_api_shed_requests_total",
+    "Requests rejected by admission control by reason",
+)
+replica_queries = Counter(
+    "birthday_api_replica_queries_total",
+    "Selects sent to database replicas by replica and result",
+)
+breaker_transitions = Counter(
+    "birthday_api_breaker_transitions_total",
+    "Transitions of database circuit breakers by database and new state",
+)
+
+METRICS = (
+    request_duration,
+    responses,
+    request_queries,
+    request_db_duration,
+    queries,
+    operation_duration,
+    shed_requests,
+    replica_queries,
+    breaker_transitions,
+)
+
+
+def render() -> str:
+    """Return all metrics in Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+def _endpoint() -> str:
+    """Return route of the current request, unmatched routes share one label"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def observe_query(seconds):
+    """Record an executed SQL query, attributing it to the current request"""
+    if has_request_context() and "metrics_start" in g:
+        g.metrics_queries += 1
+        g.metrics_db_seconds += seconds
+        queries.inc((("endpoint", _endpoint()),))
+    else:
+        queries.inc((("endpoint", ""),))
+
+
+def timed(operation):
+    """Decorator recording duration of the function as `operation`"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                operation_duration.observe(
+                    (("operation", operation),), time.perf_counter() - start
+                )
+
+        return wrapper
+
+    return decorator
+
+
+@api.before_app_request
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_db_seconds = 0.0
+
+
+@api.after_app_request
+def _record_request(response):
+    """Record latency, status and database usage of the request
+
+    For streamed responses only the time until the response is created is recorded
+    """
+    if "metrics_start" in g:
+        endpoint = _endpoint()
+        labels = (("endpoint", endpoint), ("method", request.method))
+        request_duration.observe(labels, time.perf_counter() - g.metrics_start)
+        responses.inc(
+            (
+                ("endpoint", endpoint),
+                ("method", request.method),
+                ("status", response.status_code),
+            )
+        )
+        request_queries.observe(labels, g.metrics_queries)
+        request_db_duration.observe(labels, g.metrics_db_seconds)
+    return response
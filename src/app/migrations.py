@@ -0,0 +1,226 @@
+"""Database schema migrations
+
+Schema is never changed on import, migrations are applied by the `migrate` command
+before workers start. Every applied migration is recorded in the `migrations` table,
+so the command is cheap to run on every deploy.
+
+Migrations run in transactions, except the ones marked `non_atomic`, like creating
+indexes concurrently. Those should be safe to rerun after a failure.
+
+Usage:
+    CONFIG_FILE_PATH=./config.ini birthday-api migrate
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from peewee import (
+    SQL,
+    BigIntegerField,
+    CharField,
+    DateTimeField,
+    Model,
+    SmallIntegerField,
+)
+from playhouse.migrate import PostgresqlMigrator
+from playhouse.migrate import migrate as run_operations
+
+from src.app.models import (
+    LIST_INDEX,
+    LIST_INDEX_COLUMNS,
+    VERSION_SEQUENCE,
+    Birthdays,
+    Tombstones,
+    Users,
+    db,
+    next_version,
+)
+from src.app.search import SEARCH_VECTOR
+
+
+def non_atomic(apply):
+    """Mark the migration to run outside a transaction"""
+    apply.atomic = False
+    return apply
+
+
+class Migrations(Model):
+    name = CharField(primary_key=True)
+    applied_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+
+def _create_tables():
+    """Create tables, existing ones are brought up to date by later migrations"""
+    for model in (Users, Birthdays):
+        if not db.table_exists(model):
+            db.create_tables([model])
+
+
+def _add_day_of_year_column():
+    """Add and backfill `day_of_year` for tables created before it existed"""
+    columns = [column.name for column in db.get_columns(Birthdays._meta.table_name)]
+    if "day_of_year" in columns:
+        return
+
+    migrator = PostgresqlMigrator(db.obj)
+    run_operations(
+        migrator.add_column(
+            Birthdays._meta.table_name,
+            "day_of_year",
+            SmallIntegerField(null=True),
+        )
+    )
+    Birthdays.update(
+        day_of_year=SQL("EXTRACT(DOY FROM make_date(2001, month, day))")
+    ).execute()
+    run_operations(
+        migrator.add_not_null(Birthdays._meta.table_name, "day_of_year"),
+        migrator.add_index(Birthdays._meta.table_name, ("day_of_year",)),
+    )
+
+
+def _add_users_timezone_column():
+    """Add `timezone` to users created before it existed"""
+    columns = [column.name for column in db.get_columns(Users._meta.table_name)]
+    if "timezone" in columns:
+        return
+
+    migrator = PostgresqlMigrator(db.obj)
+    run_operations(
+        migrator.add_column(
+            Users._meta.table_name, "timezone", CharField(default="UTC")
+        )
+    )
+
+
+def _add_birthdays_versions():
+    """Add change versions to birthdays and create tombstones of deleted ones"""
+    db.execute_sql(f"CREATE SEQUENCE IF NOT EXISTS {VERSION_SEQUENCE}")
+    columns = [column.name for column in db.get_columns(Birthdays._meta.table_name)]
+    if "version" not in columns:
+        migrator = PostgresqlMigrator(db.obj)
+        run_operations(
+            migrator.add_column(
+                Birthdays._meta.table_name, "version", BigIntegerField(null=True)
+            )
+        )
+        Birthdays.update(version=next_version()).execute()
+        db.execute_sql(
+            f"ALTER TABLE {Birthdays._meta.table_name} "
+            f"ALTER COLUMN version SET DEFAULT nextval('{VERSION_SEQUENCE}')"
+        )
+        run_operations(
+            migrator.add_not_null(Birthdays._meta.table_name, "version"),
+            migrator.add_index(Birthdays._meta.table_name, ("creator_id", "version")),
+        )
+    db.create_tables([Tombstones])
+
+
+def _add_birthdays_search_index():
+    """Index names and notes of birthdays for full-text search"""
+    db.execute_sql(
+        f"CREATE INDEX IF NOT EXISTS birthdays_search ON {Birthdays._meta.table_name}"
+        f" USING gin ({SEARCH_VECTOR})"
+    )
+
+
+def _create_index_concurrently(name, columns, unique=False):
+    """Create index of birthdays without blocking writes, dropping an invalid one
+
+    Failed concurrent builds leave invalid indexes behind, they are built again
+    """
+    valid = db.execute_sql(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,)
+    ).fetchone()
+    if valid is not None and valid[0]:
+        return
+    if valid is not None:
+        db.execute_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    db.execute_sql(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name}"
+        f" ON {Birthdays._meta.table_name} {columns}"
+    )
+
+
+@non_atomic
+def _add_birthdays_creator_indexes():
+    """Lead indexes of per-user queries with `creator_id`
+
+    Adds the covering index of birthday lists and swaps `UNIQUE (name, creator_id)`
+    for `UNIQUE (creator_id, name)`. Plain `creator_id` index is dropped,
+    since both of them cover it. Only the swap of constraints locks the table,
+    for as long as it takes to change the catalog
+    """
+    table = Birthdays._meta.table_name
+    _create_index_concurrently(LIST_INDEX, LIST_INDEX_COLUMNS)
+
+    old_constraint = db.execute_sql(
+        "SELECT 1 FROM pg_constraint WHERE conname = %s",
+        (f"{table}_name_creator_id_key",),
+    ).fetchone()
+    if old_constraint is not None:
+        _create_index_concurrently(
+            f"{table}_creator_id_name_key", "(creator_id, name)", unique=True
+        )
+        with db.atomic():
+            db.execute_sql("SET LOCAL lock_timeout = '10s'")
+            db.execute_sql(
+                f"ALTER TABLE {table} DROP CONSTRAINT {table}_name_creator_id_key,"
+                f" ADD CONSTRAINT {table}_creator_id_name_key"
+                f" UNIQUE USING INDEX {table}_creator_id_name_key"
+            )
+
+    db.execute_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {table}_creator_id")
+
+
+# Applied in order, names must never change once released
+MIGRATIONS = (
+    ("0001_create_tables", _create_tables),
+    ("0002_birthdays_day_of_year", _add_day_of_year_column),
+    ("0003_users_timezone", _add_users_timezone_column),
+    ("0004_birthdays_versions", _add_birthdays_versions),
+    ("0005_birthdays_search_index", _add_birthdays_search_index),
+    ("0006_birthdays_creator_indexes", _add_birthdays_creator_indexes),
+)
+
+
+def migrate() -> list:
+    """Apply migrations which weren't applied yet, return their names"""
+    db.create_tables([Migrations])
+    applied = {migration.name for migration in Migrations.select(Migrations.name)}
+
+    names = []
+    for name, apply in MIGRATIONS:
+        if name in applied:
+            continue
+        if getattr(apply, "atomic", True):
+            with db.atomic():
+                # Migrations can take longer than queries of requests
+                db.execute_sql("SET LOCAL statement_timeout = 0")
+                apply()
+                Migrations.create(name=name)
+        else:
+            db.execute_sql("SET statement_timeout = 0")
+            try:
+                apply()
+            finally:
+                db.execute_sql("RESET statement_timeout")
+            Migrations.create(name=name)
+        names.append(name)
+    return names
+
+
+@click.command("migrate")
+@with_appcontext
+def migrate_command():
+    """Apply database migrations"""
+    names = migrate()
+    for name in names:
+        click.echo(f"Applied {name}")
+    if not names:
+        click.echo("Database is up to date")
+    db.close()
@@ -1,26 +1,205 @@
 """Database and schema definitions."""
 
+import time
+import weakref
 from datetime import date
 
+import psycopg2
+from flask import has_request_context, request
 from marshmallow import Schema, ValidationError, fields, validate, validates_schema
 from peewee import (
     SQL,
+    BigIntegerField,
     CharField,
+    DatabaseProxy,
     ForeignKeyField,
+    IntegerField,
+    InterfaceError,
     Model,
+    OperationalError,
     PostgresqlDatabase,
+    Select,
     SmallIntegerField,
     TextField,
+    fn,
 )
+from playhouse.pool import MaxConnectionsExceeded, PooledPostgresqlDatabase
 
-from src.app import app, config
+from src.app import api, config, metrics, replicas
+from src.app.breaker import CircuitBreaker
 
-db = PostgresqlDatabase(
-    config.get("Database", "name"),
-    host=config.get("Database", "host"),
-    user=config.get("Database", "user"),
-    password=config.get("Database", "password"),
-)
+# Milliseconds, 0 disables the timeout
+STATEMENT_TIMEOUT = config.getint("Database", "statement_timeout", fallback=0)
+# Errors meaning the database is unavailable or too slow, they trip the breaker.
+# Exhausted local pool is not one of them, the database may be healthy
+UNAVAILABLE_ERRORS = (OperationalError, InterfaceError)
+
+
+def statement_timeout() -> int:
+    """Return statement timeout of the current route in milliseconds
+
+    Routes can override the default in `[StatementTimeouts]` section by view name
+    """
+    if not has_request_context() or request.endpoint is None:
+        return STATEMENT_TIMEOUT
+    return config.getint(
+        "StatementTimeouts",
+        request.endpoint.rpartition(".")[2],
+        fallback=STATEMENT_TIMEOUT,
+    )
+
+
+class InstrumentedDatabase:
+    """Database mixin reporting every executed query to metrics
+
+    Queries are guarded by a circuit breaker and run with the statement timeout
+    of the current route
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = CircuitBreaker(self.connect_params.get("host") or self.database)
+        # Timeouts set on connections, unless it's the default set on connect
+        self._timeouts = weakref.WeakKeyDictionary()
+
+    def _set_statement_timeout(self):
+        """Set the route's timeout, if the connection's session has another one
+
+        Inside transactions it's set for the transaction only, with `SET LOCAL`
+        before every statement: a session `SET` would be undone by a rollback
+        """
+        timeout = statement_timeout()
+        connection = self.connection()
+        if self._timeouts.get(connection, STATEMENT_TIMEOUT) == timeout:
+            return
+        if self.in_transaction():
+            super().execute_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+        else:
+            super().execute_sql(f"SET statement_timeout = {int(timeout)}")
+            self._timeouts[connection] = timeout
+
+    def execute_sql(self, *args, **kwargs):
+        self.breaker.check()
+        start = time.perf_counter()
+        try:
+            self._set_statement_timeout()
+            cursor = super().execute_sql(*args, **kwargs)
+        except MaxConnectionsExceeded:
+            # The database wasn't asked
+            self.breaker.cancel_probe()
+            raise
+        except UNAVAILABLE_ERRORS:
+            self.breaker.record_failure()
+            raise
+        except psycopg2.OperationalError as error:
+            # Peewee doesn't wrap some errors, like `QueryCanceled` of timeouts
+            self.breaker.record_failure()
+            raise OperationalError(error, *error.args) from error
+        except Exception:
+            # The database has answered
+            self.breaker.record_success()
+            raise
+        finally:
+            metrics.observe_query(time.perf_counter() - start)
+        self.breaker.record_success()
+        return cursor
+
+
+class Database(InstrumentedDatabase, PostgresqlDatabase):
+    pass
+
+
+class PooledDatabase(InstrumentedDatabase, PooledPostgresqlDatabase):
+    pass
+
+
+def _create_database(section="Database", host=None):
+    """Create database from a config section, `[Database]` by default
+
+    Options missing in the section are taken from `[Database]`, `host` overrides
+    the configured one. If `pool` is enabled, connections are kept in a pool of at most
+    `max_connections`. Idle connections older than `stale_timeout` seconds are recycled
+    and requests wait up to `wait_timeout` seconds for a free connection
+    """
+
+    def option(get, name, fallback=None):
+        return get(section, name, fallback=get("Database", name, fallback=fallback))
+
+    name = option(config.get, "name")
+    options = {
+        "host": host or option(config.get, "host"),
+        "user": option(config.get, "user"),
+        "password": option(config.get, "password"),
+    }
+    connect_timeout = option(config.getint, "connect_timeout")
+    if connect_timeout is not None:
+        options["connect_timeout"] = connect_timeout
+    if STATEMENT_TIMEOUT:
+        options["options"] = f"-c statement_timeout={STATEMENT_TIMEOUT}"
+
+    if not option(config.getboolean, "pool", fallback=False):
+        return Database(name, **options)
+
+    return PooledDatabase(
+        name,
+        max_connections=option(config.getint, "max_connections", fallback=20),
+        stale_timeout=option(config.getint, "stale_timeout", fallback=300),
+        timeout=option(config.getint, "wait_timeout", fallback=10),
+        **options,
+    )
+
+
+class RoutingDatabaseProxy(DatabaseProxy):
+    """Database proxy running selects of read-only requests on a replica"""
+
+    def execute(self, query, *args, **kwargs):
+        if (
+            isinstance(query, Select)
+            and not query._for_update
+            and not self.in_transaction()
+        ):
+            cursor = replicas.execute(query)
+            if cursor is not None:
+                return cursor
+        return self.obj.execute(query, *args, **kwargs)
+
+
+# Initialized by `init_db` when the app is created
+db = RoutingDatabaseProxy()
+
+
+def init_db():
+    """Initialize databases from config, no connection is opened until the first query"""
+    if db.obj is None:
+        db.initialize(_create_database())
+        replicas.initialize(
+            [_create_database("DatabaseReplica", host) for host in replicas.HOSTS]
+        )
+
+
+def pool_status() -> dict:
+    """Return utilization of the connection pool and state of the circuit breaker"""
+    if not isinstance(db.obj, PooledPostgresqlDatabase):
+        return {"pooled": False, "breaker": db.obj.breaker.state}
+
+    return {
+        "pooled": True,
+        "breaker": db.obj.breaker.state,
+        "max_connections": db.obj._max_connections,
+        "in_use": len(db.obj._in_use),
+        "idle": len(db.obj._connections),
+    }
+
+
+@api.teardown_app_request
+def _close_db(exception):
+    """Return the request's database connection to the pool
+
+    Connection is checked out lazily by the first query of the request,
+    so requests served without queries never touch the pool
+    """
+    if isinstance(db.obj, PooledPostgresqlDatabase) and not db.is_closed():
+        db.close()
 
 
 class BirthdaysSchema(Schema):
@@ -33,7 +212,12 @@ class BirthdaysSchema(Schema):
     )
 
     @validates_schema
-    def valid_date(self, data, **kwargs):
+    def valid_date(self, data, partial=False, **kwargs):
+        if partial:
+            # Partial updates are checked against stored values after the update
+            if not 1 <= data.get("month", 1) <= 12 or not 1 <= data.get("day", 1) <= 31:
+                raise ValidationError("Invalid date", field="date")
+            return
         try:
             year = data["year"]
             if year is None:
@@ -53,6 +237,23 @@ class BirthdaysSchema(Schema):
 birthdays_schema = BirthdaysSchema()
 
 
+def day_of_year(month, day):
+    """Return the day-of-year key for a birthday
+
+    Keys are computed in a non-leap year, so every valid birthday maps to 1..365
+    and consecutive dates (except February 29) map to consecutive keys.
+    """
+    return date(2001, month, day).timetuple().tm_yday
+
+
+def day_of_year_sql(month, day):
+    """Return SQL computing `day_of_year`, month and day can be columns or numbers
+
+    Never fails for months 1..12, so invalid dates can be rejected after the update
+    """
+    return fn.date_part("doy", fn.make_date(2001, month, 1) + (day - 1))
+
+
 class BaseModel(Model):
     class Meta:
         database = db
@@ -61,22 +262,62 @@ class BaseModel(Model):
 class Users(BaseModel):
     telegram_id = CharField(primary_key=True, unique=True)
     language = CharField(default="en")
+    # IANA time zone name, reminders are sent by the user's local date
+    timezone = CharField(default="UTC")
 
     # col_language. #one lang - en, automatic translation later.
 
 
+# Versions of birthday changes, shared by updates and deletes of all users
+VERSION_SEQUENCE = "birthdays_version_seq"
+
+
+def next_version():
+    """Return SQL taking the next change version, for updates of `Birthdays.version`"""
+    return fn.nextval(VERSION_SEQUENCE)
+
+
 class Birthdays(BaseModel):
     name = CharField()
     day = SmallIntegerField()
     month = SmallIntegerField()
     year = SmallIntegerField(null=True)
     note = TextField(null=True)
-    creator = ForeignKeyField(Users, backref="birthdays")
+    # Covered by the indexes leading with `creator`
+    creator = ForeignKeyField(Users, backref="birthdays", index=False)
+    day_of_year = SmallIntegerField(index=True)
+    # Set by the sequence on insert, should be set to `next_version()` on every update
+    version = BigIntegerField(sequence=VERSION_SEQUENCE)
 
     class Meta:
-        constraints = [SQL("UNIQUE (name, creator_id)")]
+        # Every index of per-user queries leads with `creator_id`,
+        # they are checked by the `check-plans` command
+        constraints = [SQL("UNIQUE (creator_id, name)")]
+        indexes = ((("creator", "version"), False),)
+
+    def save(self, *args, **kwargs):
+        self.day_of_year = day_of_year(self.month, self.day)
+        return super().save(*args, **kwargs)
 
 
-with app.app_context():
-    # db.drop_tables([Birthdays, Users])
-    db.create_tables([Birthdays, Users])
+# Covers lists of a user's birthdays ordered by id, so they are read by index-only scans
+LIST_INDEX = "birthdays_creator_id_id"
+LIST_INDEX_COLUMNS = "(creator_id, id) INCLUDE (name, day, month, year, note)"
+Birthdays.add_index(
+    SQL(
+        f"CREATE INDEX IF NOT EXISTS {LIST_INDEX}"
+        f" ON {Birthdays._meta.table_name} {LIST_INDEX_COLUMNS}"
+    )
+)
+
+
+class Tombstones(BaseModel):
+    """Deleted birthdays, kept for clients syncing changes since a version"""
+
+    birthday_id = IntegerField(primary_key=True)
+    # Covered by the index on `(creator, version)`
+    creator = ForeignKeyField(Users, backref="tombstones", index=False)
+    version = BigIntegerField(sequence=VERSION_SEQUENCE)
+
+    class Meta:
+        indexes = ((("creator", "version"), False),)
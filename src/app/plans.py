@@ -0,0 +1,106 @@
+"""Query plan checks of hot queries
+
+Every hot query is explained with sequential scans and merge joins disabled, so
+the planner picks an index whenever one fits, however small the tables are.
+A plan still reading a whole table, sequentially or through an index without
+a condition, has no fitting index, so the query slows down as the table grows.
+
+Usage:
+    CONFIG_FILE_PATH=./config.ini birthday-api check-plans
+"""
+
+import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from src.app.incoming import DEFAULT_WINDOW, keys_condition, parse_window, window_keys
+from src.app.models import Birthdays, Tombstones, Users, db, next_version
+from src.app.search import select_matching
+from src.app.serializers import select_birthdays
+
+# Any values work, queries are only explained
+TELEGRAM_ID = "0"
+BIRTHDAY_ID = 1
+VERSION = 1
+
+
+def _hot_queries() -> dict:
+    """Return queries behind per-user and frequent routes by their names"""
+    user_birthday = (Birthdays.creator == TELEGRAM_ID) & (Birthdays.id == BIRTHDAY_ID)
+    window = window_keys(parse_window(DEFAULT_WINDOW), datetime.date.today())
+    return {
+        "user": Users.select().where(Users.telegram_id == TELEGRAM_ID),
+        "birthdays list": select_birthdays()
+        .where(Birthdays.creator == TELEGRAM_ID)
+        .order_by(Birthdays.id),
+        "one birthday": select_birthdays().where(user_birthday),
+        "update birthday": Birthdays.update(name="name", version=next_version()).where(
+            user_birthday
+        ),
+        "delete birthday": Birthdays.delete().where(user_birthday),
+        "changes since": select_birthdays(Birthdays.version)
+        .where((Birthdays.creator == TELEGRAM_ID) & (Birthdays.version > VERSION))
+        .order_by(Birthdays.version),
+        "deleted since": Tombstones.select(Tombstones.birthday_id, Tombstones.version)
+        .where((Tombstones.creator == TELEGRAM_ID) & (Tombstones.version > VERSION))
+        .order_by(Tombstones.version),
+        "search": select_matching(TELEGRAM_ID, "name"),
+        "incoming": select_birthdays().where(keys_condition(window)),
+    }
+
+
+def _scans(plan):
+    """Yield `(node type, relation, index, full)` of every scan in the plan tree
+
+    Scan is full if it reads the whole table
+    """
+    node = plan["Node Type"]
+    if "Relation Name" in plan:
+        full = node == "Seq Scan" or (
+            node in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan
+        )
+        yield node, plan["Relation Name"], plan.get("Index Name"), full
+    for child in plan.get("Plans", ()):
+        yield from _scans(child)
+
+
+def check_plans() -> dict:
+    """Explain hot queries, return their scans by query names
+
+    Statements are explained in a transaction which is rolled back
+    """
+    result = {}
+    with db.atomic() as transaction:
+        db.execute_sql("SET LOCAL enable_seqscan = off")
+        # Merge joins prefer reading whole indexes in order on small tables
+        db.execute_sql("SET LOCAL enable_mergejoin = off")
+        for name, query in _hot_queries().items():
+            sql, params = query.sql()
+            explained = db.execute_sql(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            result[name] = list(_scans(explained.fetchone()[0][0]["Plan"]))
+        transaction.rollback()
+    return result
+
+
+@click.command("check-plans")
+@with_appcontext
+def check_plans_command():
+    """Check that hot queries use indexes, fail on scans of whole tables"""
+    failed = False
+    for name, scans in check_plans().items():
+        full = any(full for _, _, _, full in scans)
+        failed = failed or full
+        click.echo(
+            "{} {}: {}".format(
+                "FAIL" if full else "ok  ",
+                name,
+                ", ".join(
+                    f"{node} on {relation}" + (f" using {index}" if index else "")
+                    for node, relation, index, _ in scans
+                ),
+            )
+        )
+    db.close()
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,154 @@
+"""Routing of read-only requests to database replicas
+
+Routes decorated with `read_replica` run their selects on one of the replicas
+from `[DatabaseReplica] hosts`, picked in turn for every request. Writes,
+selects inside transactions and `FOR UPDATE` selects always go to the primary.
+
+A user's requests stay on the primary for `sticky_window` seconds after their
+writes, so they read their own changes despite replication lag. Writes are tracked
+per worker process. A replica failing a query is skipped for `retry_interval`
+seconds, the query and the rest of the request go to the primary.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask_jwt_extended import get_jwt_identity
+from peewee import InterfaceError, OperationalError
+from playhouse.pool import MaxConnectionsExceeded, PooledPostgresqlDatabase
+
+from src.app import api, config, metrics
+from src.app.breaker import DatabaseUnavailable
+from src.app.cache import LRUCache
+
+HOSTS = [
+    host.strip()
+    for host in config.get("DatabaseReplica", "hosts", fallback="").split(",")
+    if host.strip()
+]
+STICKY_WINDOW = config.getfloat("DatabaseReplica", "sticky_window", fallback=5)
+RETRY_INTERVAL = config.getfloat("DatabaseReplica", "retry_interval", fallback=30)
+
+
+class Replica:
+    def __init__(self, host, database):
+        self.host = host
+        self.database = database
+        # `time.monotonic()` until which the replica is skipped
+        self.down_until = 0
+
+
+# Set by `initialize` when the app is created
+_replicas = []
+_turns = itertools.count()
+_state = threading.local()
+# Telegram ids of users who wrote recently
+_written = LRUCache(
+    config.getint("DatabaseReplica", "sticky_users", fallback=10000),
+    ttl=STICKY_WINDOW,
+)
+
+
+def initialize(databases):
+    """Set replica databases, in the same order as `HOSTS`"""
+    _replicas[:] = [Replica(host, database) for host, database in zip(HOSTS, databases)]
+
+
+def mark_written(telegram_id):
+    """Keep the user's requests on the primary for a while, call after every write"""
+    if _replicas:
+        _written.set(telegram_id, True)
+
+
+def _choose():
+    """Return the next available replica, `None` if all of them are down"""
+    now = time.monotonic()
+    available = [replica for replica in _replicas if replica.down_until <= now]
+    if not available:
+        return None
+    return available[next(_turns) % len(available)]
+
+
+@contextmanager
+def on_replica(telegram_id=None):
+    """Run selects of the block on a replica, unless the user wrote recently"""
+    previous = getattr(_state, "replica", None)
+    if telegram_id is None or _written.get(telegram_id) is None:
+        _state.replica = _choose()
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def on_primary() -> bool:
+    """Check that selects of the current block run on the primary, not on a replica"""
+    return getattr(_state, "replica", None) is None
+
+
+def read_replica(func):
+    """Decorator running selects of the route on a replica
+
+    Should be applied after `jwt_required`, the user is taken from the JWT identity
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _replicas:
+            return func(*args, **kwargs)
+        identity = get_jwt_identity()
+        telegram_id = (
+            identity.get("telegram_id") if isinstance(identity, dict) else None
+        )
+        with on_replica(telegram_id):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def execute(query):
+    """Run the select on the replica of the current block
+
+    Returns `None` if the query should run on the primary
+    """
+    replica = getattr(_state, "replica", None)
+    if replica is None:
+        return None
+    try:
+        cursor = replica.database.execute(query)
+        metrics.replica_queries.inc((("replica", replica.host), ("result", "ok")))
+        return cursor
+    except (
+        OperationalError,
+        InterfaceError,
+        MaxConnectionsExceeded,
+        DatabaseUnavailable,
+    ) as error:
+        logging.warning(
+            "Replica %s failed, using primary for %s seconds: %s",
+            replica.host,
+            RETRY_INTERVAL,
+            error,
+        )
+        metrics.replica_queries.inc((("replica", replica.host), ("result", "failed")))
+        replica.down_until = time.monotonic() + RETRY_INTERVAL
+        _state.replica = None
+        try:
+            replica.database.close()
+        except Exception:
+            pass
+        return None
+
+
+@api.teardown_app_request
+def _close_replicas(exception):
+    """Return replica connections of the request to their pools"""
+    _state.replica = None
+    for replica in _replicas:
+        database = replica.database
+        if isinstance(database, PooledPostgresqlDatabase) and not database.is_closed():
+            database.close()
@@ -0,0 +1,68 @@
+"""Search of a user's birthdays by name and note
+
+Birthdays are matched with Postgres full-text search over a GIN expression index,
+so no extension is required. Every word of the search string is matched as a prefix,
+which suits typeahead. Names weigh more than notes, birthdays with names starting
+with the search string come first.
+"""
+
+import re
+
+from peewee import SQL, Case, Expression, fn
+
+from src.app.models import Birthdays
+from src.app.serializers import birthday_to_dict, select_birthdays
+
+# Should be the same as the indexed expression to use the index
+SEARCH_VECTOR = (
+    "(setweight(to_tsvector('simple', name), 'A')"
+    " || setweight(to_tsvector('simple', coalesce(note, '')), 'B'))"
+)
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+def search_query(text):
+    """Return a prefix `tsquery` string matching all words of the text, or `None`"""
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def select_matching(telegram_id, text, limit=DEFAULT_SEARCH_LIMIT):
+    """Return a query of the user's birthdays matching the text, best matches first
+
+    Returns `None` if the text has no words
+    """
+    query = search_query(text)
+    if query is None:
+        return None
+
+    vector = SQL(SEARCH_VECTOR)
+    tsquery = fn.to_tsquery(SQL("'simple'"), query)
+    return (
+        select_birthdays()
+        .where((Birthdays.creator == telegram_id) & Expression(vector, "@@", tsquery))
+        .order_by(
+            Case(None, [(Birthdays.name ** f"{_escape_like(text.strip())}%", 0)], 1),
+            fn.ts_rank(vector, tsquery).desc(),
+            Birthdays.id,
+        )
+        .limit(limit)
+    )
+
+
+def search_birthdays(telegram_id, text, limit=DEFAULT_SEARCH_LIMIT) -> list:
+    """Return serialized birthdays of the user matching the text, best matches first
+
+    Returns an empty list if the text has no words
+    """
+    rows = select_matching(telegram_id, text, limit)
+    if rows is None:
+        return []
+    return [birthday_to_dict(row) for row in rows]
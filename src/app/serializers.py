@@ -0,0 +1,70 @@
+"""Serialization of birthdays for API responses
+
+Birthdays are selected as tuples of exactly the columns that are returned,
+with the creator joined in the same query, instead of `model_to_dict`
+which issues an extra query per birthday to fetch its creator.
+Produced dictionaries have the same shape as `model_to_dict` output.
+"""
+
+from flask import current_app
+
+from src.app.encoding import MSGPACK_MIMETYPES, to_msgpack, wants_msgpack
+from src.app.metrics import timed
+from src.app.models import Birthdays, Users
+
+BIRTHDAY_COLUMNS = (
+    Birthdays.id,
+    Birthdays.name,
+    Birthdays.day,
+    Birthdays.month,
+    Birthdays.year,
+    Birthdays.note,
+    Users.telegram_id,
+    Users.language,
+)
+
+
+def select_birthdays(*extra_columns):
+    """Return a tuples query of serializable birthday columns
+
+    Extra columns are appended after the serializable ones
+    """
+    return (
+        Birthdays.select(*BIRTHDAY_COLUMNS, *extra_columns)
+        .join(Users, on=(Birthdays.creator == Users.telegram_id))
+        .tuples()
+    )
+
+
+def birthday_to_dict(row) -> dict:
+    """Convert a row selected by `select_birthdays` to a dictionary"""
+    id, name, day, month, year, note, telegram_id, language = row[:8]
+    return {
+        "id": id,
+        "name": name,
+        "day": day,
+        "month": month,
+        "year": year,
+        "note": note,
+        "creator": {"telegram_id": telegram_id, "language": language},
+    }
+
+
+@timed("serialization")
+def to_json(data) -> str:
+    """Encode data the same way `jsonify` does, without a trailing newline"""
+    return current_app.json.dumps(data, separators=(",", ":"))
+
+
+def json_response(data):
+    """Return data as a JSON response, same as `jsonify`
+
+    Clients preferring MessagePack get it instead, without encoding JSON first
+    """
+    if wants_msgpack():
+        return current_app.response_class(
+            to_msgpack(data), mimetype=MSGPACK_MIMETYPES[0]
+        )
+    return current_app.response_class(
+        to_json(data) + "\n", mimetype=current_app.json.mimetype
+    )
@@ -0,0 +1,129 @@
+"""Aggregated statistics of birthdays and users for admin dashboards
+
+Every summary is a single `GROUP BY` query returning a few rows. Results are cached
+until the next write: writes bump a global generation, which is a part of cache keys,
+so a summary computed before a write is never returned after it. Writes are tracked
+per worker process, so summaries also expire after `[Stats] ttl` seconds
+and changes made through other workers are seen eventually.
+"""
+
+import datetime
+import threading
+
+from peewee import JOIN, SQL, Case, fn
+
+from src.app import config
+from src.app.cache import LRUCache, SingleFlight
+from src.app.models import Birthdays, Users
+
+_generation = 0
+_generation_lock = threading.Lock()
+_cache = LRUCache(32, ttl=config.getint("Stats", "ttl", fallback=60))
+_flight = SingleFlight()
+
+
+def mark_stale():
+    """Drop cached summaries, should be called after every write"""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+
+def totals(today) -> dict:
+    """Return numbers of users and birthdays, birthdays with years and with notes"""
+    birthdays, with_year, with_note = (
+        Birthdays.select(
+            fn.count(Birthdays.id), fn.count(Birthdays.year), fn.count(Birthdays.note)
+        )
+        .tuples()
+        .get()
+    )
+    return {
+        "users": Users.select().count(),
+        "birthdays": birthdays,
+        "with_year": with_year,
+        "with_note": with_note,
+    }
+
+
+def by_month(today) -> list:
+    """Return numbers of birthdays in every month"""
+    counts = dict(
+        Birthdays.select(Birthdays.month, fn.count(Birthdays.id))
+        .group_by(Birthdays.month)
+        .tuples()
+    )
+    return [
+        {"month": month, "birthdays": counts.get(month, 0)} for month in range(1, 13)
+    ]
+
+
+def by_weekday(today) -> list:
+    """Return numbers of birthdays by ISO weekday of their next occurrence"""
+    this_year = fn.make_date(today.year, Birthdays.month, Birthdays.day)
+    occurrence = Case(
+        None,
+        [(this_year >= today, this_year)],
+        fn.make_date(today.year + 1, Birthdays.month, Birthdays.day),
+    )
+    weekday = fn.date_part("isodow", occurrence)
+    counts = {
+        int(day): count
+        for day, count in Birthdays.select(weekday, fn.count(Birthdays.id))
+        .group_by(weekday)
+        .tuples()
+    }
+    return [{"weekday": day, "birthdays": counts.get(day, 0)} for day in range(1, 8)]
+
+
+def by_list_size(today) -> list:
+    """Return numbers of users by number of their birthdays, including empty lists"""
+    sizes = (
+        Users.select(fn.count(Birthdays.id).alias("size"))
+        .join(Birthdays, JOIN.LEFT_OUTER)
+        .group_by(Users.telegram_id)
+        .alias("sizes")
+    )
+    return [
+        {"size": size, "users": users}
+        for size, users in Users.select(sizes.c.size, fn.count(SQL("*")))
+        .from_(sizes)
+        .group_by(sizes.c.size)
+        .order_by(sizes.c.size)
+        .tuples()
+    ]
+
+
+def by_language(today) -> list:
+    """Return numbers of users by language"""
+    return [
+        {"language": language, "users": users}
+        for language, users in Users.select(Users.language, fn.count(Users.telegram_id))
+        .group_by(Users.language)
+        .order_by(Users.language)
+        .tuples()
+    ]
+
+
+SUMMARIES = {
+    "totals": totals,
+    "months": by_month,
+    "weekdays": by_weekday,
+    "list_sizes": by_list_size,
+    "languages": by_language,
+}
+
+
+def summary(name):
+    """Return the summary by its name in `SUMMARIES`, computed at most once per write
+
+    Raises `KeyError` if there is no such summary
+    """
+    compute = SUMMARIES[name]
+    today = datetime.date.today()
+    key = (name, _generation, today)
+    value = _cache.get(key)
+    if value is None:
+        value = _flight.do(key, lambda: compute(today))
+        _cache.set(key, value)
+    return value
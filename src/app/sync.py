@@ -0,0 +1,109 @@
+"""Change tracking of birthdays for delta sync
+
+Every insert and update of a birthday takes the next value of a shared sequence
+as its `version`, every delete leaves a tombstone with a version of the same sequence.
+Clients keep the greatest version they've seen and ask only for newer changes.
+
+Versions are taken when rows are written, not when transactions commit. Writes of
+a user run in `user_transaction`, one at a time, so the user's versions commit
+in order: once a version is visible, all lower versions of the user are visible too.
+"""
+
+from contextlib import contextmanager
+
+from peewee import fn
+
+from src.app.models import Birthdays, Tombstones, Users, db
+from src.app.serializers import birthday_to_dict, select_birthdays
+
+
+@contextmanager
+def user_transaction(user):
+    """Transaction for writes of the user's birthdays, waiting for the user's other ones
+
+    Every write taking versions should run in it. Can be nested
+    """
+    with db.atomic():
+        # Released on commit or rollback, hash collisions only serialize two users
+        db.execute_sql(
+            "SELECT pg_advisory_xact_lock(hashtext(%s))", (str(user.telegram_id),)
+        )
+        yield
+
+
+def delete_birthdays(user, condition) -> list:
+    """Delete the user's birthdays matching the condition, leaving tombstones
+
+    Returns ids of deleted birthdays
+    """
+    with user_transaction(user):
+        ids = [
+            id
+            for id, in Birthdays.delete()
+            .where((Birthdays.creator == user) & condition)
+            .returning(Birthdays.id)
+            .tuples()
+            .execute()
+        ]
+        if ids:
+            Tombstones.insert_many(
+                [{"birthday_id": id, "creator": user} for id in ids]
+            ).execute()
+    return ids
+
+
+def _latest_version(telegram_id) -> int:
+    """Return the greatest version of the user's birthdays and tombstones, 0 if none"""
+    birthdays = Birthdays.select(fn.max(Birthdays.version)).where(
+        Birthdays.creator == telegram_id
+    )
+    tombstones = Tombstones.select(fn.max(Tombstones.version)).where(
+        Tombstones.creator == telegram_id
+    )
+    latest = (
+        Users.select(fn.coalesce(fn.greatest(birthdays, tombstones), 0))
+        .where(Users.telegram_id == telegram_id)
+        .scalar()
+    )
+    return latest or 0
+
+
+def changes_since(telegram_id, version) -> dict:
+    """Return the user's birthdays changed after the version and ids of deleted ones
+
+    Result has the greatest `version` among the changes, or the same version
+    if there are none. Deletes are skipped for version 0, a client syncing from
+    scratch has nothing to delete.
+
+    Birthdays and tombstones are selected by separate statements, which may see
+    different commits. Both only return changes up to the user's latest version
+    selected first, all of them are committed already, newer ones are left
+    for the next sync
+    """
+    latest = max(version, _latest_version(telegram_id))
+    birthdays = [
+        birthday_to_dict(row)
+        for row in select_birthdays()
+        .where(
+            (Birthdays.creator == telegram_id)
+            & (Birthdays.version > version)
+            & (Birthdays.version <= latest)
+        )
+        .order_by(Birthdays.version)
+    ]
+
+    deleted = []
+    if version > 0:
+        deleted = [
+            id
+            for id, in Tombstones.select(Tombstones.birthday_id)
+            .where(
+                (Tombstones.creator == telegram_id)
+                & (Tombstones.version > version)
+                & (Tombstones.version <= latest)
+            )
+            .order_by(Tombstones.version)
+            .tuples()
+        ]
+
+    return {"version": latest, "birthdays": birthdays, "deleted": deleted}
@@ -1,21 +1,45 @@
 """Different helper functions, classes and decorators"""
 
-import base64
-import hmac
+import logging
 from datetime import datetime
 from functools import wraps
-from hashlib import sha256
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
-from flask import abort, jsonify, make_response
+from flask import abort, current_app, jsonify, make_response
 from flask_jwt_extended import get_jwt, verify_jwt_in_request
+from peewee import InterfaceError, OperationalError
+from playhouse.pool import MaxConnectionsExceeded
 from werkzeug.exceptions import HTTPException
 
-from src.app import app, config
+from src.app import api, config, jwt
+from src.app.breaker import DatabaseUnavailable
+from src.app.cache import LRUCache
+from src.app.encoding import encode_response
+from src.app.keys import decrypted_cache, private_keys
+from src.app.metrics import timed
+from src.app.models import Users
+from src.app.verification import (
+    VerificationPool,
+    check_telegram_data,
+    decrypt,
+    telegram_secret,
+)
 
 TELEGRAM_BOT_TOKEN = config.get("Main", "telegram_bot_token")
+TELEGRAM_SECRET = telegram_secret(TELEGRAM_BOT_TOKEN)
+
+verification_pool = None
+if config.getint("Crypto", "processes", fallback=0) > 0:
+    verification_pool = VerificationPool(
+        config.getint("Crypto", "processes"),
+        config.getfloat("Crypto", "timeout", fallback=2),
+        TELEGRAM_BOT_TOKEN,
+        [key_file.path for key_file in private_keys],
+    )
+
+users_cache = LRUCache(
+    config.getint("Cache", "users_cache_size", fallback=4096),
+    ttl=config.getint("Cache", "users_cache_ttl", fallback=600),
+)
 
 
 class PubicKeyError(Exception):
@@ -37,7 +61,7 @@ class CustomError(HTTPException):
         self.description = description
 
 
-@app.errorhandler(CustomError)
+@api.app_errorhandler(CustomError)
 def handle_custom_error(e):
     """Error handler for CustomError class
 
@@ -52,81 +76,91 @@ def handle_custom_error(e):
         e.code,
     )
     response.content_type = "application/json"
-    app.logger.error(f"{datetime.now()}:  {response.get_data(as_text=True)}")
+    current_app.logger.error("%s:  %s", datetime.now(), response.get_data(as_text=True))
     return response
 
 
-@app.errorhandler(HTTPException)
+@api.app_errorhandler(HTTPException)
 def general_exception_handler(e):
-    """General error handler for HTTPException class"""
-    response = make_response(
-        {
-            "name": e.name,
-            "description": e.description,
-        },
-        e.code,
-    )
+    """General error handler for HTTPException class
+
+    Headers of the exception, like `Retry-After`, are kept.
+    Responses to queries rejected by the circuit breaker have its state in `breaker`
+    """
+    body = {
+        "name": e.name,
+        "description": e.description,
+    }
+    if isinstance(e, DatabaseUnavailable):
+        body["breaker"] = e.state
+    response = make_response(body, e.code)
+    for key, value in e.get_headers():
+        if key != "Content-Type":
+            response.headers[key] = value
     response.content_type = "application/json"
-    app.logger.error(f"{datetime.now()}:  {response.get_data(as_text=True)}")
+    current_app.logger.error("%s:  %s", datetime.now(), response.get_data(as_text=True))
     return response
 
 
-@app.after_request
+@api.after_app_request
 def add_header(response):
     """Add headers before sending response"""
     response.headers.add("Access-Control-Allow-Headers", "X-CSRF-TOKEN, Content-Type")
     response.headers.add("Access-Control-Allow-Credentials", "true")
     response.headers.add(
-        "Access-Control-Allow-Methods", "GET,HEAD,POST,DELETE,PUT,OPTIONS"
+        "Access-Control-Allow-Methods", "GET,HEAD,POST,DELETE,PUT,PATCH,OPTIONS"
     )
     return response
 
 
+@api.after_app_request
+def negotiate_encoding(response):
+    """Send response as MessagePack and compressed if the client accepts it"""
+    return encode_response(response)
+
+
+@timed("check_telegram_data")
 def _check_telegram_data(data_dict) -> bool:
     """Check if data from Telegram is valid
 
-    Logic description can be found [here](https://core.telegram.org/widgets/login#checking-authorization)
+    Runs in the verification pool if it's enabled, timing out is a failed check
     """
+    if verification_pool is None:
+        return check_telegram_data(data_dict, TELEGRAM_SECRET)
     try:
-        secret_key = sha256(bytes(TELEGRAM_BOT_TOKEN, "utf-8")).digest()
-        hash = data_dict.pop("hash")
-        sorted_tuples = sorted(data_dict.items())
-        data_list = []
-        for key, value in sorted_tuples:
-            data_list.append(f"{key}={value}")
-        data_string = "\n".join(data_list)
-        hash_compose = hmac.new(
-            key=secret_key,
-            msg=bytes(data_string, "utf-8"),
-            digestmod=sha256,
-        ).hexdigest()
-        return hash_compose == hash
-    except Exception:
+        return verification_pool.check_telegram_data(data_dict)
+    except TimeoutError:
+        logging.warning("Telegram data check timed out")
         return False
 
 
+@timed("decrypt")
 def _decrypt(data):
-    """Decrypt data using private key"""
-    encrypted_data = base64.b64decode(data)
-
-    with open(config.get("Keys", "private"), "rb") as f:
-        private_key = serialization.load_pem_private_key(
-            f.read(), password=None, backend=default_backend()
-        )
+    """Decrypt data using private keys
 
-    try:
-        decrypted_data = private_key.decrypt(
-            encrypted_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None,
-            ),
-        )
-    except ValueError:
+    Keys are tried in the configured order.
+    Successful decryptions are cached until the keys change or the cache entry expires.
+    Runs in the verification pool if it's enabled, timing out raises `PubicKeyError`
+    """
+    keys = [key_file.get() for key_file in private_keys]
+    cache_key = (data, *(key_file.version for key_file in private_keys))
+    decrypted_data = decrypted_cache.get(cache_key)
+    if decrypted_data is not None:
+        return decrypted_data
+
+    if verification_pool is None:
+        decrypted_data = decrypt(data, keys)
+    else:
+        try:
+            decrypted_data = verification_pool.decrypt(data)
+        except TimeoutError:
+            logging.warning("Decryption timed out")
+            raise PubicKeyError
+    if decrypted_data is None:
         raise PubicKeyError
 
-    return decrypted_data.decode("utf-8")
+    decrypted_cache.set(cache_key, decrypted_data)
+    return decrypted_data
 
 
 def admin_required(func):
@@ -144,13 +178,49 @@ def admin_required(func):
     return decorator
 
 
+@jwt.user_lookup_loader
+def _load_user(jwt_header, jwt_data):
+    """Resolve `current_user` of the request from its JWT identity
+
+    Called once per request by `jwt_required`, users are cached between requests,
+    so most requests don't query `Users` at all. Admin identity is returned as is.
+    Runs before views and their error handling, so database errors are converted
+    to `503` here
+    """
+    identity = jwt_data[current_app.config["JWT_IDENTITY_CLAIM"]]
+    if not isinstance(identity, dict):
+        return identity
+
+    telegram_id = identity["telegram_id"]
+    user = users_cache.get(telegram_id)
+    if user is None:
+        try:
+            user = Users.get_or_none(Users.telegram_id == telegram_id)
+        except (OperationalError, InterfaceError, MaxConnectionsExceeded) as error:
+            logging.error(
+                "Error loading user with telegram_id: %s, Error: %s", telegram_id, error
+            )
+            _abort_error(error)
+        if user is not None:
+            users_cache.set(telegram_id, user)
+    return user
+
+
 def _abort_error(error):
     """Abort with error message
 
     If error is HTTPException, abort with error code and description.
+    If database connection pool is exhausted, database is unavailable or timed out,
+    or the circuit breaker is open, abort with 503.
     Otherwise, abort with 500 and error message.
     """
+    if isinstance(error, DatabaseUnavailable):
+        raise error
     if isinstance(error, HTTPException):
         abort(error.code, description=error.description)
+    elif isinstance(error, MaxConnectionsExceeded):
+        abort(503, description="No free database connections")
+    elif isinstance(error, (OperationalError, InterfaceError)):
+        abort(503, description="Database is unavailable or too slow")
     else:
         abort(500, description=f"Unexpected {error=}")
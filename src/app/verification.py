@@ -0,0 +1,180 @@
+"""Verification of login credentials, optionally in a process pool
+
+Decryption of the bot token and the check of Telegram login data are CPU-bound and
+hold the GIL. With `[Crypto] processes` above zero they run in a pool of processes,
+so threads of the worker keep serving other requests. Pool processes parse private
+keys and compute the Telegram secret once, when they start.
+
+The pool is started in every worker process before its first request, all its
+processes are spawned in the background, rather than forked, since workers run
+background threads. Calls arriving before the processes are ready wait for them.
+Spawned processes import the main module, so run the app with gunicorn or
+`birthday-api` rather than as a script.
+Calls taking longer than `[Crypto] timeout` seconds are treated as failed.
+This module is imported by pool processes, so it doesn't import the application.
+"""
+
+import base64
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+OAEP_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None,
+)
+
+
+def telegram_secret(bot_token) -> bytes:
+    return sha256(bytes(bot_token, "utf-8")).digest()
+
+
+def decrypt(data, keys):
+    """Decrypt base64 encoded data with the first fitting key, `None` if none fits"""
+    encrypted_data = base64.b64decode(data)
+    for private_key in keys:
+        try:
+            return private_key.decrypt(encrypted_data, OAEP_PADDING).decode("utf-8")
+        except ValueError:
+            continue
+    return None
+
+
+def check_telegram_data(data_dict, secret) -> bool:
+    """Check if data from Telegram is valid
+
+    Logic description can be found [here](https://core.telegram.org/widgets/login#checking-authorization)
+    """
+    try:
+        hash = data_dict.pop("hash")
+        sorted_tuples = sorted(data_dict.items())
+        data_list = []
+        for key, value in sorted_tuples:
+            data_list.append(f"{key}={value}")
+        data_string = "\n".join(data_list)
+        hash_compose = hmac.new(
+            key=secret,
+            msg=bytes(data_string, "utf-8"),
+            digestmod=sha256,
+        ).hexdigest()
+        return hash_compose == hash
+    except Exception:
+        return False
+
+
+# State of a pool process, set by `_init_process`
+_secret = None
+_key_paths = ()
+_keys = {}
+
+
+def _init_process(bot_token, key_paths):
+    global _secret, _key_paths
+    _secret = telegram_secret(bot_token)
+    _key_paths = key_paths
+    _private_keys()
+
+
+def _private_keys() -> list:
+    """Return private keys of the pool process, reloading modified key files"""
+    keys = []
+    for path in _key_paths:
+        mtime = os.stat(path).st_mtime_ns
+        loaded = _keys.get(path)
+        if loaded is None or loaded[0] != mtime:
+            with open(path, "rb") as f:
+                key = serialization.load_pem_private_key(
+                    f.read(), password=None, backend=default_backend()
+                )
+            loaded = _keys[path] = (mtime, key)
+        keys.append(loaded[1])
+    return keys
+
+
+def _decrypt_in_process(data):
+    return decrypt(data, _private_keys())
+
+
+def _check_in_process(data_dict) -> bool:
+    return check_telegram_data(data_dict, _secret)
+
+
+def _ready():
+    return True
+
+
+class VerificationPool:
+    """Process pool started in every worker, with a timeout for every call"""
+
+    def __init__(self, processes, timeout, bot_token, key_paths):
+        self.processes = processes
+        self.timeout = timeout
+        self._initargs = (bot_token, tuple(key_paths))
+        self._executor = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        """Drop the pool inherited by a forked process, its threads are gone"""
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start pool processes unless started, without waiting for them to be ready
+
+        Called before every request, so processes run in workers, not in a gunicorn
+        master preloading the app
+        """
+        if self._executor is None:
+            self._get_executor()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_process,
+                    initargs=self._initargs,
+                )
+                # Spawn all processes now instead of one per call, they get ready
+                # in the background
+                for _ in range(self.processes):
+                    executor.submit(_ready)
+                self._executor = executor
+            return self._executor
+
+    def _call(self, func, *args):
+        """Return result of the call, raise `TimeoutError` if it's too long"""
+        executor = self._get_executor()
+        try:
+            future = executor.submit(func, *args)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError
+        except BrokenProcessPool:
+            logging.error("Verification pool is broken, restarting it")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise TimeoutError
+
+    def decrypt(self, data):
+        """Decrypt data in the pool, `None` if no key fits"""
+        return self._call(_decrypt_in_process, data)
+
+    def check_telegram_data(self, data_dict) -> bool:
+        return self._call(_check_in_process, data_dict)
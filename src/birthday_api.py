@@ -1,6 +1,21 @@
-"""Birthday API entry point"""
+"""Birthday API entry point
+
+The app is created once on import, run gunicorn with `--preload` so workers are
+forked from it. Apply database migrations with `birthday-api migrate` before start,
+check that hot queries use indexes with `birthday-api check-plans`.
+"""
+
+from flask.cli import FlaskGroup
+
+from src.app import create_app
+
+app = create_app()
+
+
+def main():
+    """Command line interface, e.g. `birthday-api migrate`"""
+    FlaskGroup(create_app=lambda: app).main()
 
-from src.app import admin_endpoints, app, endpoints, logger
 
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=8080, debug=False)